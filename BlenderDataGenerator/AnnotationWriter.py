@@ -0,0 +1,87 @@
+'''
+Streaming annotation sink, every record is appended to a JSON Lines file as soon
+as its frame is done so a crashed run keeps everything written up to that point.
+'''
+import json
+import os
+
+class AnnotationWriter():
+    def __init__(self, annotationFilePath, fileName = 'annotation.jsonl', resume = False, sync = True):
+        '''
+        Opens the JSON Lines file, with resume the existing records are kept,
+        otherwise the file is started from scratch
+
+        sync calls os.fsync after every record so it survives a hard crash
+        '''
+        self.filePath = os.path.join(annotationFilePath, fileName)
+        self.annotationFilePath = annotationFilePath
+        self.sync = sync
+
+        #Highest id written so far
+        self.lastIndex = None
+
+        if resume and os.path.isfile(self.filePath):
+            self.repair()
+            for record in self.records():
+                if self.lastIndex is None or record['id'] > self.lastIndex:
+                    self.lastIndex = record['id']
+            self.file = open(self.filePath, 'a')
+        else:
+            self.file = open(self.filePath, 'w')
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def repair(self):
+        '''
+        Drops a partially written last line, which is what a crash in the middle
+        of a write leaves behind
+        '''
+        with open(self.filePath, 'rb+') as infile:
+            content = infile.read()
+            end = content.rfind(b'\n') + 1
+            if end != len(content):
+                infile.truncate(end)
+
+    def write(self, record):
+        '''Appends one record and flushes it to disk'''
+        self.file.write(json.dumps(record) + '\n')
+        self.file.flush()
+        if self.sync:
+            os.fsync(self.file.fileno())
+
+        if self.lastIndex is None or record['id'] > self.lastIndex:
+            self.lastIndex = record['id']
+
+    def records(self):
+        '''Reads back all the complete records written so far'''
+        records = []
+        with open(self.filePath) as infile:
+            for line in infile:
+                if line.strip():
+                    records.append(json.loads(line))
+        return records
+
+    def finalize(self, fileName = 'annotation.json'):
+        '''
+        Writes the records in the {'images' : [...]} format sorted by id,
+        the file is replaced atomically so readers never see half of it
+        '''
+        self.file.flush()
+
+        images = sorted(self.records(), key=lambda record: record['id'])
+
+        annotationfile = os.path.join(self.annotationFilePath, fileName)
+        temporaryfile = annotationfile + '.tmp'
+        with open(temporaryfile, 'w+') as outfile:
+            json.dump({'images' : images}, outfile, indent=4)
+        os.replace(temporaryfile, annotationfile)
+
+        return annotationfile
+
+    def close(self):
+        if not self.file.closed:
+            self.file.close()
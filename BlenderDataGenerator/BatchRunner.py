@@ -0,0 +1,238 @@
+'''
+Manifest driven generation for many models.
+
+A manifest (JSON or YAML) lists the models and their settings, every entry is a
+job rendered by its own blender worker process. Jobs that finished are skipped
+when the manifest is run again, unfinished jobs resume where they stopped, and
+a combined index with the model id of every record is written at the end.
+
+Example manifest:
+
+{
+    "output" : "./dataset",
+    "workers" : 4,
+    "defaults" : {"frames" : 1000, "resolution" : [640, 480], "profile" : "balanced", "seed" : 0},
+    "jobs" : [
+        {"id" : "satellite01", "model" : "models/satellite01.obj"},
+        {"id" : "satellite02", "model" : "models/satellite02.obj", "frames" : 500, "profile" : "fast"}
+    ]
+}
+'''
+import json
+import multiprocessing
+import os
+import time
+import traceback
+
+#Settings a job can have and their values when neither the job nor the defaults set them
+JOB_DEFAULTS = {'frames' : 100,
+                'resolution' : None,
+                'profile' : None,
+                'seed' : None,
+                'format' : 'PNG',
+                'maskFormat' : 'npy',
+                'segmentationMode' : 'memory',
+                'sceneCachePath' : None,
+                'randomization' : None}
+
+DONE_FILE = 'job.done'
+
+def loadManifest(manifestPath):
+    '''
+    Reads a JSON or YAML manifest and returns the output path, the worker count and
+    the list of jobs with the defaults filled in
+    '''
+    with open(manifestPath) as infile:
+        if manifestPath.endswith(('.yaml', '.yml')):
+            try:
+                import yaml
+            except ImportError:
+                raise ImportError('PyYAML is needed for YAML manifests, pip install pyyaml or use JSON')
+            manifest = yaml.safe_load(infile)
+        else:
+            manifest = json.load(infile)
+
+    #A plain list is a list of jobs
+    if isinstance(manifest, list):
+        manifest = {'jobs' : manifest}
+
+    defaults = dict(JOB_DEFAULTS)
+    defaults.update(manifest.get('defaults', {}))
+
+    jobs = []
+    ids = set()
+    for entry in manifest['jobs']:
+        job = dict(defaults)
+        job.update(entry)
+
+        if 'id' not in job:
+            job['id'] = os.path.splitext(os.path.basename(job['model']))[0]
+        if job['id'] in ids:
+            raise ValueError('Duplicate job id in manifest: ' + str(job['id']))
+        ids.add(job['id'])
+
+        jobs.append(job)
+
+    return manifest.get('output', './'), manifest.get('workers'), jobs
+
+def jobProgress(jobPath):
+    '''Number of frames a job has written so far'''
+    streamFile = os.path.join(jobPath, 'annotation', 'annotation.jsonl')
+    if not os.path.isfile(streamFile):
+        return 0
+    with open(streamFile, 'rb') as infile:
+        return sum(1 for line in infile if line.endswith(b'\n'))
+
+def runJob(job):
+    '''
+    Worker entry point, renders one model in a fresh blender process and marks the job as done
+
+    Errors are returned instead of raised so one broken model does not stop the others
+    '''
+    start = time.time()
+    try:
+        from . import SatteliteData
+
+        generator = SatteliteData.Generator(filePath=job['path'],
+                                            objectFilePath=job['model'],
+                                            segmentationMode=job['segmentationMode'],
+                                            seed=job['seed'],
+                                            sceneCachePath=job['sceneCachePath'])
+
+        if job['profile']:
+            generator.setRenderProfile(job['profile'], resolution=job['resolution'])
+        elif job['resolution']:
+            generator.scene.render.resolution_x = job['resolution'][0]
+            generator.scene.render.resolution_y = job['resolution'][1]
+
+        generator.setSegmentationNodes()
+
+        #Settings of Randomization.Randomizer, e.g. {"sunAngle" : 0.5, "roughness" : [0.2, 0.8]}
+        if job['randomization']:
+            generator.setRandomization(**job['randomization'])
+
+        #An interrupted job continues after its last written frame
+        generator.generateData(job['frames'], format=job['format'], maskFormat=job['maskFormat'],
+                               resume=jobProgress(job['path']) > 0)
+
+        status = {'id' : job['id'], 'status' : 'done', 'frames' : job['frames'],
+                  'seconds' : time.time() - start}
+
+        with open(os.path.join(job['path'], DONE_FILE), 'w+') as outfile:
+            json.dump(status, outfile, indent=4)
+
+        return status
+
+    except Exception:
+        return {'id' : job['id'], 'status' : 'failed', 'error' : traceback.format_exc(),
+                'seconds' : time.time() - start}
+
+def writeProgress(outputPath, jobs, statuses):
+    '''Writes progress.json with the status and written frames of every job'''
+    progress = []
+    for job in jobs:
+        status = dict(statuses.get(job['id'], {'status' : 'pending'}))
+        status['id'] = job['id']
+        status['written'] = jobProgress(job['path'])
+        status['frames'] = job['frames']
+        progress.append(status)
+
+    temporaryfile = os.path.join(outputPath, 'progress.json.tmp')
+    with open(temporaryfile, 'w+') as outfile:
+        json.dump({'jobs' : progress}, outfile, indent=4)
+    os.replace(temporaryfile, os.path.join(outputPath, 'progress.json'))
+
+def writeDatasetIndex(outputPath, jobs):
+    '''
+    Combines the annotation of every finished job into dataset_index.json,
+    every record gets its model_id and the job directory its files are relative to
+    '''
+    images = []
+    models = []
+
+    for job in jobs:
+        annotationfile = os.path.join(job['path'], 'annotation', 'annotation.json')
+        if not os.path.isfile(os.path.join(job['path'], DONE_FILE)) or not os.path.isfile(annotationfile):
+            continue
+
+        with open(annotationfile) as infile:
+            records = json.load(infile)['images']
+
+        root = os.path.relpath(job['path'], outputPath)
+        for record in records:
+            record['model_id'] = job['id']
+            record['root'] = root
+        images.extend(records)
+
+        models.append({'id' : job['id'], 'model' : job['model'], 'root' : root, 'frames' : len(records)})
+
+    indexfile = os.path.join(outputPath, 'dataset_index.json')
+    with open(indexfile, 'w+') as outfile:
+        json.dump({'models' : models, 'images' : images}, outfile, indent=4)
+
+    return indexfile
+
+def runManifest(manifestPath, workers = None, interval = 10.0):
+    '''
+    Runs every job of a manifest over a pool of blender worker processes
+
+    Jobs with a job.done marker are skipped, progress.json is refreshed every interval
+    seconds, returns the status of every job
+    '''
+    outputPath, manifestWorkers, jobs = loadManifest(manifestPath)
+    os.makedirs(outputPath, exist_ok=True)
+
+    for job in jobs:
+        job['path'] = os.path.join(outputPath, job['id'])
+
+    if workers is None:
+        workers = manifestWorkers or os.cpu_count() or 1
+
+    statuses = {}
+    todo = []
+    for job in jobs:
+        if os.path.isfile(os.path.join(job['path'], DONE_FILE)):
+            statuses[job['id']] = {'status' : 'done', 'skipped' : True}
+            print('Skipping finished job: ' + job['id'])
+        else:
+            todo.append(job)
+
+    #Spawn and one job per process so every job starts from a clean blender
+    context = multiprocessing.get_context('spawn')
+    with context.Pool(processes=max(1, min(workers, len(todo) or 1)), maxtasksperchild=1) as pool:
+        results = {job['id'] : pool.apply_async(runJob, (job,)) for job in todo}
+        for job in todo:
+            statuses[job['id']] = {'status' : 'queued'}
+
+        while results:
+            writeProgress(outputPath, jobs, statuses)
+
+            for jobId, result in list(results.items()):
+                if result.ready():
+                    statuses[jobId] = result.get()
+                    del results[jobId]
+
+                    finished = sum(1 for status in statuses.values() if status['status'] in ('done', 'failed'))
+                    print('[{finished}/{total}] {id} {status}'.format(finished=finished, total=len(jobs),
+                                                                    id=jobId, status=statuses[jobId]['status']))
+                    if statuses[jobId]['status'] == 'failed':
+                        print(statuses[jobId]['error'])
+
+            #Wakes up early when the oldest job finishes
+            if results:
+                next(iter(results.values())).wait(interval)
+
+    writeProgress(outputPath, jobs, statuses)
+    writeDatasetIndex(outputPath, jobs)
+
+    return statuses
+
+if __name__ == '__main__':
+    import argparse
+
+    parser = argparse.ArgumentParser(description='Runs every job of a generation manifest')
+    parser.add_argument('manifest', help='JSON or YAML manifest')
+    parser.add_argument('--workers', type=int, default=None)
+    args = parser.parse_args()
+
+    runManifest(args.manifest, workers=args.workers)
@@ -0,0 +1,249 @@
+'''
+Lazy reader of the generated data for training.
+
+The annotation is parsed once into compact arrays (ids, quaternions, translations)
+and the records, masks and images are only read when a sample is accessed. Masks
+are memory mapped whatever format they were written in (see MaskStorage.MaskReader),
+samples exported to tar shards are read through TarExporter.ShardReader.
+
+Datasets can be sliced, shuffled and split between workers, every view shares the
+parsed index of the dataset it came from so nothing is read twice.
+
+Example:
+
+    dataset = Dataset('./output')
+    train = dataset[:9000].shuffle(seed=0)
+    for sample in train.shard(count=4, index=0):
+        mask = sample['mask']
+'''
+import json
+import os
+
+import numpy as np
+
+from .MaskStorage import MaskReader
+from .TarExporter import ShardReader, decodeSample
+
+class Dataset():
+    def __init__(self, filePath = './', shardPath = None, loadImages = False, index = None, rows = None):
+        '''
+        filePath is the working directory of a Generator (with annotation/ and data/),
+        an annotation directory or file, or the output of a manifest run with dataset_index.json
+
+        shardPath is the ShardWriter output directory for samples that were exported to shards,
+        loadImages decodes the images with PIL instead of only returning their paths
+        '''
+        self.filePath = filePath
+        self.shardPath = shardPath
+        self.loadImages = loadImages
+
+        #Parsed once, views of the dataset share it
+        self.index = index if index is not None else self.buildIndex(filePath)
+        self.rows = np.arange(len(self.index['ids'])) if rows is None else np.asarray(rows, dtype=np.int64)
+
+        #Readers hold open files, they are created per process on first use
+        self.readers = {}
+        self.readerPid = None
+
+    @staticmethod
+    def findAnnotation(filePath):
+        '''Annotation file of an output directory, the streamed .jsonl when the run did not finish'''
+        if os.path.isfile(filePath):
+            return filePath
+
+        for name in ('dataset_index.json', 'annotation/annotation.json', 'annotation.json',
+                     'annotation/annotation.jsonl', 'annotation.jsonl'):
+            path = os.path.join(filePath, name)
+            if os.path.isfile(path):
+                return path
+
+        raise FileNotFoundError('No annotation found in ' + str(filePath))
+
+    @classmethod
+    def buildIndex(cls, filePath):
+        '''Parses the annotation into the records and the compact per sample arrays'''
+        annotationFile = cls.findAnnotation(filePath)
+
+        if annotationFile.endswith('.jsonl'):
+            records = []
+            with open(annotationFile) as infile:
+                for line in infile:
+                    #A crashed run can leave half a line behind
+                    try:
+                        records.append(json.loads(line))
+                    except ValueError:
+                        break
+            records.sort(key=lambda record: record['id'])
+        else:
+            with open(annotationFile) as infile:
+                records = json.load(infile)['images']
+
+        baseDirectory = os.path.dirname(os.path.abspath(annotationFile))
+        if os.path.basename(annotationFile) == 'dataset_index.json':
+            #Records of a manifest run point to their job directory
+            roots = [os.path.join(baseDirectory, record['root']) for record in records]
+        elif os.path.basename(baseDirectory) == 'annotation':
+            roots = [os.path.dirname(baseDirectory)] * len(records)
+        else:
+            roots = [baseDirectory] * len(records)
+
+        count = len(records)
+        quaternions = np.zeros((count, 4), dtype=np.float32)
+        translations = np.full((count, 3), np.nan, dtype=np.float32)
+        for i, record in enumerate(records):
+            quaternions[i] = record['quaternion']
+            if 'translation' in record:
+                translations[i] = record['translation']
+
+        return {'records' : records,
+                'roots' : roots,
+                'ids' : np.array([record['id'] for record in records], dtype=np.int64),
+                'quaternions' : quaternions,
+                'translations' : translations}
+
+    def view(self, rows):
+        '''Dataset over the given rows of this one, sharing the parsed index'''
+        return Dataset(self.filePath, shardPath=self.shardPath, loadImages=self.loadImages,
+                       index=self.index, rows=rows)
+
+    def __len__(self):
+        return len(self.rows)
+
+    def __getitem__(self, item):
+        '''An integer returns a sample, a slice or an array of positions returns a view'''
+        if isinstance(item, (int, np.integer)):
+            return self.sample(int(self.rows[item]))
+        return self.view(self.rows[item])
+
+    def __iter__(self):
+        '''
+        Iterates over the samples, inside a torch DataLoader worker only the share of
+        that worker is read
+        '''
+        rows = self.rows
+        try:
+            from torch.utils.data import get_worker_info
+            worker = get_worker_info()
+            if worker is not None:
+                rows = rows[worker.id::worker.num_workers]
+        except ImportError:
+            pass
+
+        for row in rows:
+            yield self.sample(int(row))
+
+    def shuffle(self, seed = None):
+        '''View of the dataset in a random order'''
+        return self.view(np.random.default_rng(seed).permutation(self.rows))
+
+    def shard(self, count, index):
+        '''View of every count-th sample starting at index, e.g. for one of count workers'''
+        return self.view(self.rows[index::count])
+
+    @property
+    def ids(self):
+        return self.index['ids'][self.rows]
+
+    @property
+    def quaternions(self):
+        '''(N,4) float32 quaternions [w,x,y,z] of the samples'''
+        return self.index['quaternions'][self.rows]
+
+    @property
+    def translations(self):
+        '''(N,3) float32 translations in the camera frame, NaN for records without them'''
+        return self.index['translations'][self.rows]
+
+    def records(self):
+        '''Annotation records of the samples'''
+        return [self.index['records'][row] for row in self.rows]
+
+    def reader(self, kind, path):
+        '''Mask or shard reader of a directory, recreated in a forked worker process'''
+        if self.readerPid != os.getpid():
+            self.readers = {}
+            self.readerPid = os.getpid()
+
+        key = (kind, path)
+        if key not in self.readers:
+            self.readers[key] = MaskReader(path) if kind == 'mask' else ShardReader(path)
+        return self.readers[key]
+
+    def shardSample(self, record):
+        '''Decoded members of a sample that was exported to a tar shard'''
+        if self.shardPath is None:
+            raise ValueError('Sample {id} is stored in a shard, set shardPath'.format(id=record['id']))
+
+        reader = self.reader('shard', self.shardPath)
+        shard = [entry['shard'] for entry in reader.shards].index(record['shard'])
+        key = record['segmentation_file'][:-len('.mask.npy')]
+
+        return decodeSample(reader.readSample(shard, key))
+
+    def sample(self, row):
+        '''
+        Returns the sample of index row as a dictionary with the record fields, the
+        quaternion as float32, the memory mapped mask, the extra passes and the image
+        '''
+        record = self.index['records'][row]
+        root = self.index['roots'][row]
+        annotationPath = os.path.join(root, 'annotation')
+
+        sample = dict(record)
+        sample['quaternion'] = self.index['quaternions'][row]
+
+        if 'shard' in record:
+            members = self.shardSample(record)
+            sample['mask'] = members.get('mask.npy')
+            for name in ('depth', 'normal'):
+                if name + '.npy' in members:
+                    sample[name] = members[name + '.npy']
+            images = [extension for extension in members if extension not in ('json', 'mask.npy')
+                      and not extension.endswith('.npy')]
+            sample['image'] = members[images[0]] if images else None
+            return sample
+
+        sample['mask'] = self.reader('mask', annotationPath).read(record)
+
+        for name in ('depth', 'normal'):
+            if record.get(name + '_file'):
+                sample[name] = np.load(os.path.join(annotationPath, record[name + '_file']), mmap_mode='r')
+
+        sample['image'] = None
+        if record.get('image_file'):
+            imagePath = self.imagePath(root, record['image_file'])
+            sample['image_path'] = imagePath
+            if self.loadImages and imagePath:
+                sample['image'] = self.readImage(imagePath)
+
+        return sample
+
+    def imagePath(self, root, imageFile):
+        '''Image files are recorded without the extension of the render format'''
+        dataPath = os.path.join(root, 'data')
+        path = os.path.join(dataPath, imageFile)
+        if os.path.splitext(imageFile)[1] and os.path.isfile(path):
+            return path
+
+        for extension in ('.png', '.jpg', '.exr', '.tif', '.bmp'):
+            if os.path.isfile(path + extension):
+                return path + extension
+
+        return None
+
+    def readImage(self, imagePath):
+        '''Decodes an image into a numpy array, PIL is only needed when images are loaded'''
+        try:
+            from PIL import Image
+        except ImportError:
+            raise ImportError('Pillow is needed to load images, pip install pillow or use the image paths')
+
+        with Image.open(imagePath) as image:
+            return np.asarray(image)
+
+    def close(self):
+        '''Closes the open mask archives'''
+        for (kind, path), reader in self.readers.items():
+            if kind == 'mask':
+                reader.close()
+        self.readers = {}
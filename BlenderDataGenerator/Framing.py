@@ -0,0 +1,53 @@
+'''
+Camera framing from the object geometry.
+
+The world space bounding box and the reach of the geometry from the pivot are
+computed once with numpy, the camera rig rotates around the object axis so the
+distance that keeps everything in view only depends on how far the geometry
+reaches from that pivot.
+'''
+import numpy as np
+
+MODES = ('sphere', 'box')
+
+def computeFraming(points, pivot = (0.0, 0.0, 0.0)):
+    '''
+    Bounding box of world space points
+
+    pivotRadius is the distance of the farthest point from the pivot the camera rotates around,
+    the radius of the sphere around the pivot that holds the geometry
+    '''
+    points = np.asarray(points, dtype=np.float64)
+    pivot = np.asarray(pivot, dtype=np.float64)
+
+    return {'min' : points.min(axis=0),
+            'max' : points.max(axis=0),
+            'pivotRadius' : float(np.linalg.norm(points - pivot, axis=1).max())}
+
+def fitDistance(framing, fov, mode = 'sphere'):
+    '''
+    Camera distance from the pivot that keeps the geometry in view for a field of view in radians
+
+    'sphere' encloses the geometry in a sphere around the pivot, nothing is clipped for
+    any rotation of the rig
+    'box' uses the full 3D diagonal of the bounding box like the original planar fit,
+    tighter framing but corners may leave the view for some rotations
+    '''
+    if mode not in MODES:
+        raise ValueError('Unknown framing mode: ' + str(mode))
+
+    if mode == 'sphere':
+        return framing['pivotRadius'] / np.sin(fov / 2.0)
+
+    diagonal = np.linalg.norm(framing['max'] - framing['min'])
+    return diagonal / (2.0 * np.tan(fov / 2.0))
+
+def boundBoxCorners(objects):
+    '''World space corners of the bound_box of every object stacked in a (K*8,3) array'''
+    corners = np.array([[list(corner) for corner in obj.bound_box] for obj in objects], dtype=np.float64)
+    matrices = np.array([[list(row) for row in obj.matrix_world] for obj in objects], dtype=np.float64)
+
+    #One batched transform for all the objects
+    world = np.einsum('kij,knj->kni', matrices[:,:3,:3], corners) + matrices[:,None,:3,3]
+
+    return world.reshape(-1, 3)
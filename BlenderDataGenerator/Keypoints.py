@@ -0,0 +1,105 @@
+'''
+2D keypoint labels for pose estimation.
+
+A fixed set of 3D keypoints is chosen once per model, the corners of the object
+bounding boxes, user supplied landmarks or vertices picked by farthest point
+sampling, and every frame projects all of them with one matmul through the
+camera matrix (see Projection.projectPoints).
+
+Visibility follows COCO: 0 outside of the image or behind the camera, 1 inside
+the image but covered by something else in the segmentation mask, 2 visible.
+Only numpy is used so the labels can be recomputed outside of blender.
+'''
+import numpy as np
+
+SOURCES = ('bbox', 'landmarks', 'fps')
+
+def farthestPointSampling(points, count, start = 0):
+    '''
+    Indices of count points that are spread over the point set, every next point
+    is the one farthest from the points chosen so far
+    '''
+    points = np.asarray(points, dtype=np.float64)
+    count = min(count, len(points))
+
+    indices = np.empty(count, dtype=np.int64)
+    if count == 0:
+        return indices
+
+    indices[0] = start
+    distances = np.einsum('ij,ij->i', points - points[start], points - points[start])
+
+    for k in range(1, count):
+        indices[k] = np.argmax(distances)
+        offset = points - points[indices[k]]
+        distances = np.minimum(distances, np.einsum('ij,ij->i', offset, offset))
+
+    return indices
+
+def keypointVisibility(pixels, depth, labels, mask, radius = 2):
+    '''
+    COCO visibility flag of every projected keypoint
+
+    labels is the pass index of the object each keypoint belongs to, a keypoint is
+    visible when its object shows up in the mask within radius pixels, keypoints on
+    the silhouette or on a bounding box corner rarely hit the object pixel exactly
+    '''
+    height, width = mask.shape
+    count = len(pixels)
+    visibility = np.zeros(count, dtype=np.int64)
+
+    if count == 0:
+        return visibility
+
+    with np.errstate(invalid='ignore'):
+        inImage = (depth > 0.0) & (pixels[:,0] >= 0.0) & (pixels[:,0] < width) \
+                  & (pixels[:,1] >= 0.0) & (pixels[:,1] < height)
+    visibility[inImage] = 1
+
+    #Mask pixels of a (2r+1)^2 window around every keypoint, gathered in one indexing call
+    window = np.arange(-radius, radius + 1)
+    x = np.floor(np.clip(np.nan_to_num(pixels[:,0]), -1, width)).astype(np.int64)
+    y = np.floor(np.clip(np.nan_to_num(pixels[:,1]), -1, height)).astype(np.int64)
+    columns = np.clip(x[:,None,None] + window[None,None,:], 0, width - 1)
+    rows = np.clip(y[:,None,None] + window[None,:,None], 0, height - 1)
+
+    hits = (np.rint(mask[rows, columns]) == np.asarray(labels)[:,None,None]).any(axis=(1,2))
+    visibility[inImage & hits] = 2
+
+    return visibility
+
+def cocoKeypoints(pixels, visibility, offsets):
+    '''
+    COCO keypoint annotations of every object, offsets holds the index of the first
+    keypoint of each object
+
+    Returns a dictionary of pass index -> {'keypoints' : [x1,y1,v1,...], 'num_keypoints' : n},
+    keypoints that are not labeled are written as 0,0,0
+    '''
+    labeled = visibility > 0
+    coordinates = np.where(labeled[:,None], pixels, 0.0)
+    triplets = np.concatenate((coordinates, visibility[:,None]), axis=1)
+
+    annotations = {}
+    ends = np.append(offsets[1:], len(pixels))
+    for i, (start, end) in enumerate(zip(offsets, ends)):
+        if end <= start:
+            continue
+        values = triplets[start:end].ravel().tolist()
+        #Visibility flags are integers in COCO
+        values[2::3] = [int(v) for v in values[2::3]]
+        annotations[i+1] = {'keypoints' : values,
+                            'num_keypoints' : int(labeled[start:end].sum())}
+
+    return annotations
+
+def cameraTranslation(viewMatrix, point):
+    '''
+    Position of a world space point in camera coordinates with x right, y down and
+    z forward, the convention of the intrinsics from Projection.intrinsicsFromProjection
+    '''
+    viewMatrix = np.asarray(viewMatrix, dtype=np.float64)
+    x, y, z = viewMatrix[:3,:3] @ np.asarray(point, dtype=np.float64) + viewMatrix[:3,3]
+
+    #Blender cameras look down -z with y up
+    return [float(x), float(-y), float(-z)]
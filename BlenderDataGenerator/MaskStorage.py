@@ -0,0 +1,365 @@
+'''
+Compact storage for the segmentation masks.
+
+The IndexOB pass only holds small integer object pass indices, so the masks are
+stored with the smallest integer dtype that fits the number of objects instead
+of float64. Supported formats:
+
+'npy'    : one compact .npy file per frame
+'rle'    : COCO style run length encoding per object inside the annotation record
+'npz'    : compressed .npz archives holding chunkSize frames each
+'memmap' : one memory mappable .npy array holding every frame of the run
+
+Every record carries the information needed to find its mask, MaskReader
+uses it to load a single frame without touching the others.
+'''
+import os
+import threading
+
+import numpy as np
+
+FORMATS = ('npy', 'rle', 'npz', 'memmap')
+
+def maskDtype(numObjects):
+    '''Smallest unsigned integer dtype that holds the pass indices 0..numObjects'''
+    for dtype in (np.uint8, np.uint16, np.uint32):
+        if numObjects <= np.iinfo(dtype).max:
+            return np.dtype(dtype)
+    return np.dtype(np.uint64)
+
+def toIntegerMask(segmentation, dtype):
+    '''Converts a float pass index image into an integer mask'''
+    return np.rint(segmentation).astype(dtype)
+
+def maskFormatOf(record):
+    '''Storage format of the mask of an annotation record'''
+    if record.get('segmentation_file') is None:
+        return 'rle'
+    if 'segmentation_key' in record:
+        return 'npz'
+    if 'segmentation_index' in record:
+        return 'memmap'
+    return 'npy'
+
+def maskStatistics(mask, numObjects, boxes = None):
+    '''
+    Tight bounding box, pixel area, centroid and bounding box coverage of every label
+    in an integer mask, computed from two bincounts over the pixels
+
+    The row and column histograms of every label give the area, the centroid and the
+    first and last row and column the label appears in. boxes are the projected
+    [x, y, width, height] boxes keyed by label, the bounding box coverage is the area of
+    the mask box over the area of the projected box. It drops below 1 when the object's
+    extent is cut off by occluders or the image border, an object covered in its middle
+    keeps its full extent and stays at 1
+
+    Returns a dictionary of label -> {'bbox', 'area', 'centroid', 'bbox_coverage'} for
+    every label that is in the mask, labels of boxes that are not in the mask at all
+    get {'area' : 0, 'bbox_coverage' : 0.0}
+    '''
+    height, width = mask.shape
+    labels = numObjects + 1
+    indices = mask.astype(np.intp)
+
+    #Pixel count of every (label, row) and every (label, column)
+    rows = np.bincount((indices * height + np.arange(height)[:,None]).ravel(),
+                       minlength=labels * height).reshape((labels, height))
+    columns = np.bincount((indices * width + np.arange(width)[None,:]).ravel(),
+                          minlength=labels * width).reshape((labels, width))
+
+    areas = rows.sum(axis=1)
+    present = np.flatnonzero(areas[1:]) + 1
+
+    rows = rows[present]
+    columns = columns[present]
+
+    #Centroid of the pixel centers
+    centroidX = (columns @ (np.arange(width) + 0.5)) / areas[present]
+    centroidY = (rows @ (np.arange(height) + 0.5)) / areas[present]
+
+    rows = rows > 0
+    columns = columns > 0
+    top = np.argmax(rows, axis=1)
+    bottom = height - np.argmax(rows[:,::-1], axis=1)
+    left = np.argmax(columns, axis=1)
+    right = width - np.argmax(columns[:,::-1], axis=1)
+
+    statistics = {}
+    for k, label in enumerate(present.tolist()):
+        box = [int(left[k]), int(top[k]), int(right[k] - left[k]), int(bottom[k] - top[k])]
+        entry = {'bbox' : box,
+                 'area' : int(areas[label]),
+                 'centroid' : [float(centroidX[k]), float(centroidY[k])]}
+
+        if boxes is not None and label in boxes:
+            projected = boxes[label][2] * boxes[label][3]
+            entry['bbox_coverage'] = min(1.0, box[2] * box[3] / projected) if projected > 0 else 0.0
+
+        statistics[label] = entry
+
+    #Objects in view of the projection that are hidden completely
+    for label in (boxes or {}):
+        if label not in statistics:
+            statistics[label] = {'area' : 0, 'bbox_coverage' : 0.0}
+
+    return statistics
+
+def encodeRLE(mask, labels = None):
+    '''
+    COCO uncompressed run length encoding of every label in an integer mask
+
+    COCO runs are counted in column major order and always start with a run of
+    background, the label image is run length encoded once and every binary
+    encoding is derived from those runs
+
+    Returns a dictionary of label -> {'size' : [h, w], 'counts' : [...]}
+    '''
+    height, width = mask.shape
+    flat = mask.ravel(order='F')
+
+    #Runs of the label image
+    changes = np.flatnonzero(flat[1:] != flat[:-1]) + 1
+    starts = np.concatenate(([0], changes))
+    values = flat[starts]
+    lengths = np.diff(np.append(starts, flat.size))
+
+    if labels is None:
+        labels = np.unique(values)
+        labels = labels[labels != 0]
+
+    encodings = {}
+    for label in labels:
+        inside = values == label
+
+        #Merge neighbouring runs that are on the same side of the binary mask
+        boundaries = np.flatnonzero(np.concatenate(([True], inside[1:] != inside[:-1])))
+        counts = np.add.reduceat(lengths, boundaries)
+
+        #Counts have to start with the background
+        if inside[0]:
+            counts = np.concatenate(([0], counts))
+
+        encodings[int(label)] = {'size' : [height, width], 'counts' : counts.tolist()}
+
+    return encodings
+
+def decodeRLE(rle):
+    '''Decodes a COCO uncompressed run length encoding into a boolean mask'''
+    height, width = rle['size']
+    counts = np.asarray(rle['counts'], dtype=np.int64)
+
+    #Every second run is foreground
+    values = np.zeros(len(counts), dtype=bool)
+    values[1::2] = True
+
+    flat = np.repeat(values, counts)
+    return flat.reshape((height, width), order='F')
+
+class MaskWriter():
+    def __init__(self, annotationFilePath, format = 'npy', numObjects = 255, shape = None,
+                 firstIndex = 0, endIndex = None, chunkSize = 256, resume = False, nextIndex = None):
+        '''
+        Writes the masks of a run in the given format
+
+        shape, firstIndex and endIndex are needed by 'memmap', the array holds
+        the frames range(firstIndex, endIndex) so shards never share a file
+
+        'npz' chunks hold the frames of one range of chunkSize indices counted from
+        firstIndex, whatever order the frames arrive in. nextIndex is the first frame
+        this writer receives (the resume point, firstIndex by default), the chunks are
+        released in index order from there so no record is committed before an earlier one
+        '''
+        if format not in FORMATS:
+            raise ValueError('Unknown mask format: ' + str(format))
+
+        self.annotationFilePath = annotationFilePath
+        self.format = format
+        self.dtype = maskDtype(numObjects)
+        self.chunkSize = chunkSize
+
+        #Frames and records of the npz chunks that are not written yet keyed by chunk number,
+        #records of written chunks wait in ready until every earlier chunk is released,
+        #write can be called from several threads so the chunks are locked
+        self.firstIndex = firstIndex
+        self.endIndex = endIndex
+        self.nextIndex = firstIndex if nextIndex is None else nextIndex
+        self.chunks = {}
+        self.pending = {}
+        self.ready = {}
+        self.nextChunk = (self.nextIndex - firstIndex) // chunkSize
+        self.lock = threading.Lock()
+
+        self.memmap = None
+        if format == 'memmap':
+            self.memmapFile = 'segmentation_{first}-{last}.npy'.format(first=firstIndex, last=endIndex-1)
+            memmapPath = os.path.join(annotationFilePath, self.memmapFile)
+
+            if resume and os.path.isfile(memmapPath):
+                self.memmap = np.lib.format.open_memmap(memmapPath, mode='r+')
+            else:
+                self.memmap = np.lib.format.open_memmap(memmapPath, mode='w+', dtype=self.dtype,
+                                                        shape=(endIndex - firstIndex,) + tuple(shape))
+
+    def write(self, index, segmentation, record):
+        '''
+        Stores the mask of frame index and adds its location to record
+
+        Returns the records whose masks are safely on disk, for 'npz' the records
+        are held back until their chunk is written
+        '''
+        mask = toIntegerMask(segmentation, self.dtype)
+
+        if self.format == 'npy':
+            segmentationFile = 'segmentation{index}.npy'.format(index=index)
+            np.save(os.path.join(self.annotationFilePath, segmentationFile), mask)
+            record['segmentation_file'] = segmentationFile
+
+        elif self.format == 'rle':
+            record['segmentation_file'] = None
+            record['segmentation_rle'] = encodeRLE(mask)
+            #Frames without any object have no encoding to take the size from
+            record['segmentation_size'] = list(mask.shape)
+
+        elif self.format == 'memmap':
+            row = index - self.firstIndex
+            self.memmap[row] = mask
+            self.memmap.flush()
+            record['segmentation_file'] = self.memmapFile
+            record['segmentation_index'] = row
+
+        elif self.format == 'npz':
+            key = (index - self.firstIndex) // self.chunkSize
+            with self.lock:
+                self.chunks.setdefault(key, {})[index] = mask
+                self.pending.setdefault(key, []).append(record)
+                if len(self.chunks[key]) < self.chunkLength(key):
+                    return []
+                chunk, records = self.takeChunk(key)
+            self.writeChunk(chunk, records)
+            return self.release(key, records)
+
+        return [record]
+
+    def chunkLength(self, key):
+        '''Number of frames of chunk key this writer receives'''
+        start = max(self.firstIndex + key * self.chunkSize, self.nextIndex)
+        end = self.firstIndex + (key + 1) * self.chunkSize
+        if self.endIndex is not None:
+            end = min(end, self.endIndex)
+        return end - start
+
+    def takeChunk(self, key):
+        '''Takes an npz chunk and its records out of the pending chunks'''
+        return self.chunks.pop(key, {}), self.pending.pop(key, [])
+
+    def release(self, key, records):
+        '''
+        Marks the records of a written chunk as ready and returns the records of every
+        chunk that is now complete in order
+        '''
+        released = []
+        with self.lock:
+            self.ready[key] = records
+            while self.nextChunk in self.ready:
+                released.extend(self.ready.pop(self.nextChunk))
+                self.nextChunk += 1
+        return released
+
+    def writeChunk(self, chunk, records):
+        '''Compresses a chunk into its archive and adds its location to the records'''
+        if not chunk:
+            return []
+
+        indices = sorted(chunk)
+        segmentationFile = 'segmentation_{first}-{last}.npz'.format(first=indices[0], last=indices[-1])
+
+        np.savez_compressed(os.path.join(self.annotationFilePath, segmentationFile),
+                            **{str(index) : mask for index, mask in chunk.items()})
+
+        #Frames can arrive out of order, the records are released sorted
+        records.sort(key=lambda record: record['id'])
+        for record in records:
+            record['segmentation_file'] = segmentationFile
+            record['segmentation_key'] = str(record['id'])
+
+        return records
+
+    def flush(self):
+        '''
+        Writes the incomplete npz chunks and returns every record that was held back
+        in index order, the frames after a missing one are released as well
+        '''
+        with self.lock:
+            taken = [(key,) + self.takeChunk(key) for key in sorted(self.chunks)]
+
+        for key, chunk, records in taken:
+            self.writeChunk(chunk, records)
+            with self.lock:
+                self.ready[key] = records
+
+        with self.lock:
+            released = []
+            for key in sorted(self.ready):
+                released.extend(self.ready.pop(key))
+            if taken:
+                self.nextChunk = max(self.nextChunk, taken[-1][0] + 1)
+        return released
+
+    def close(self):
+        '''Writes whatever is left and returns the records that were held back'''
+        records = self.flush()
+
+        if self.memmap is not None:
+            self.memmap.flush()
+            self.memmap = None
+
+        return records
+
+class MaskReader():
+    def __init__(self, annotationFilePath):
+        '''
+        Reads single masks back from any of the storage formats,
+        archives are opened lazily and kept open for the following reads
+        '''
+        self.annotationFilePath = annotationFilePath
+        self.archives = {}
+
+    def open(self, segmentationFile):
+        '''Opens an archive without reading any of its frames'''
+        if segmentationFile not in self.archives:
+            path = os.path.join(self.annotationFilePath, segmentationFile)
+            if segmentationFile.endswith('.npz'):
+                #np.load on npz only decompresses the members that are accessed
+                self.archives[segmentationFile] = np.load(path)
+            else:
+                self.archives[segmentationFile] = np.load(path, mmap_mode='r')
+        return self.archives[segmentationFile]
+
+    def read(self, record):
+        '''Returns the integer mask of an annotation record'''
+        segmentationFile = record.get('segmentation_file')
+
+        if segmentationFile is None:
+            rle = record['segmentation_rle']
+            size = record.get('segmentation_size') or next((encoding['size'] for encoding in rle.values()), None)
+            if size is None:
+                raise ValueError('Mask size of record {id} is unknown, it has no objects and no segmentation_size'.format(id=record.get('id')))
+            mask = np.zeros(size, dtype=maskDtype(max((int(label) for label in rle), default=0)))
+            for label, encoding in rle.items():
+                mask[decodeRLE(encoding)] = int(label)
+            return mask
+
+        if 'segmentation_key' in record:
+            return self.open(segmentationFile)[record['segmentation_key']]
+
+        if 'segmentation_index' in record:
+            return self.open(segmentationFile)[record['segmentation_index']]
+
+        #One file per frame, memory mapped so nothing is read until it is used
+        return np.load(os.path.join(self.annotationFilePath, segmentationFile), mmap_mode='r')
+
+    def close(self):
+        for archive in self.archives.values():
+            if hasattr(archive, 'close'):
+                archive.close()
+        self.archives = {}
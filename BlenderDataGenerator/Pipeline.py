@@ -0,0 +1,83 @@
+'''
+Bounded producer/consumer pipeline used to overlap rendering with saving.
+
+The render loop submits work (mask conversion, compression, file writes) to a
+thread pool and keeps rendering. Results are handed to the consumer in
+submission order on the calling thread, at most maxPending jobs are in flight
+so memory stays bounded, and an exception raised in a worker is raised again
+in the render loop the next time it submits or drains.
+'''
+import collections
+from concurrent.futures import ThreadPoolExecutor
+
+class OrderedPipeline():
+    def __init__(self, consumer = None, workers = 2, maxPending = None):
+        '''
+        consumer is called with the result of every job in submission order,
+        with workers = 0 the jobs run directly in submit
+        '''
+        self.consumer = consumer
+        self.workers = workers
+        self.maxPending = maxPending if maxPending else max(1, 2*workers)
+
+        self.executor = ThreadPoolExecutor(max_workers=workers) if workers > 0 else None
+        self.pending = collections.deque()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, excType, excValue, traceback):
+        if excType is None:
+            self.close()
+        else:
+            #Do not wait for the rest when the loop itself failed
+            self.shutdown()
+
+    def consume(self, result):
+        if self.consumer is not None:
+            self.consumer(result)
+
+    def submit(self, function, *args, **kwargs):
+        '''Queues a job, blocks while maxPending jobs are still running'''
+        if self.executor is None:
+            self.consume(function(*args, **kwargs))
+            return
+
+        self.pending.append(self.executor.submit(function, *args, **kwargs))
+        self.collect()
+
+    def collect(self):
+        '''
+        Hands finished results to the consumer in order, waits for the oldest job
+        while the pipeline is full, result() raises the error of a failed job here
+        '''
+        while self.pending and (self.pending[0].done() or len(self.pending) >= self.maxPending):
+            future = self.pending.popleft()
+            try:
+                result = future.result()
+            except Exception:
+                self.shutdown()
+                raise
+            self.consume(result)
+
+    def drain(self):
+        '''Waits for every queued job'''
+        while self.pending:
+            future = self.pending.popleft()
+            try:
+                result = future.result()
+            except Exception:
+                self.shutdown()
+                raise
+            self.consume(result)
+
+    def shutdown(self):
+        '''Stops the pool without running the jobs that have not started'''
+        if self.executor is not None:
+            self.executor.shutdown(wait=True, cancel_futures=True)
+            self.executor = None
+        self.pending.clear()
+
+    def close(self):
+        self.drain()
+        self.shutdown()
@@ -0,0 +1,154 @@
+'''
+Batched sampling of camera orientations uniformly distributed over SO(3).
+
+Poses are a pure function of (seed, index), any pose can be drawn without
+drawing the ones before it, so sharded and resumed runs render the same pose
+for the same index.
+'''
+import numpy as np
+
+METHODS = ('random', 'stratified', 'halton')
+
+#First primes used as halton bases for the three dimensions of the unit cube
+HALTON_BASES = (2, 3, 5)
+
+def shoemake(u):
+    '''
+    Maps (N,3) points of the unit cube to (N,4) unit quaternions [w,x,y,z]
+
+    The map preserves the uniform measure, uniform points give uniformly distributed
+    rotations and low discrepancy points give an even coverage of SO(3)
+    Shoemake, Uniform random rotations, Graphics Gems III, 1992
+    '''
+    u = np.asarray(u, dtype=np.float64)
+    u1, u2, u3 = u[:,0], u[:,1], u[:,2]
+
+    r1 = np.sqrt(1.0 - u1)
+    r2 = np.sqrt(u1)
+    theta1 = 2.0 * np.pi * u2
+    theta2 = 2.0 * np.pi * u3
+
+    quaternions = np.empty((len(u), 4), dtype=np.float64)
+    quaternions[:,0] = r2 * np.cos(theta2)
+    quaternions[:,1] = r1 * np.sin(theta1)
+    quaternions[:,2] = r1 * np.cos(theta1)
+    quaternions[:,3] = r2 * np.sin(theta2)
+
+    return quaternions
+
+def radicalInverse(indices, base):
+    '''Van der Corput radical inverse of every index in the given base'''
+    indices = np.array(indices, dtype=np.int64)
+    result = np.zeros(indices.shape, dtype=np.float64)
+    factor = 1.0 / base
+
+    while np.any(indices > 0):
+        indices, digit = np.divmod(indices, base)
+        result += digit * factor
+        factor /= base
+
+    return result
+
+def indexedRandom(seed, indices, width, stream, blockSize = 1024):
+    '''
+    Uniform random numbers (N,width) that only depend on seed, stream and the index,
+    used for per frame parameters that have to be reproducible in sharded runs
+    '''
+    indices = np.asarray(indices, dtype=np.int64)
+    values = np.empty((len(indices), width), dtype=np.float64)
+    blocks = indices // blockSize
+    offsets = indices % blockSize
+
+    for block in np.unique(blocks):
+        rng = np.random.default_rng(np.random.SeedSequence(seed, spawn_key=(int(stream), int(block))))
+        selected = blocks == block
+        values[selected] = rng.random((blockSize, width))[offsets[selected]]
+
+    return values
+
+class PoseSampler():
+    def __init__(self, seed = None, method = 'random', blockSize = 1024):
+        '''
+        method is one of:
+        'random'     : independent uniform rotations
+        'stratified' : latin hypercube stratification over the poses of the run, see setRange
+        'halton'     : randomly shifted halton sequence, low discrepancy over the whole run
+
+        Random numbers are drawn per block of blockSize poses from a generator seeded
+        with (seed, block), so a pose only depends on the seed and its index.
+        Stratified poses also depend on the range of the run they are stratified over
+        '''
+        if method not in METHODS:
+            raise ValueError('Unknown pose sampling method: ' + str(method))
+
+        #Fix the entropy once so an unseeded sampler is still indexable
+        self.seed = np.random.SeedSequence(seed).entropy
+        self.method = method
+        self.blockSize = blockSize
+
+        #Poses the stratification spans, blocks of blockSize from 0 until setRange is called
+        self.rangeStart = 0
+        self.rangeSize = None
+
+    def setRange(self, start, amount):
+        '''
+        Stratifies over the poses start..start+amount-1 as one block, so every run gets
+        the full latin hypercube guarantee whatever its length. Resumed and sharded parts
+        of a run have to use the range of the whole run to draw the same poses
+        '''
+        self.rangeStart = int(start)
+        self.rangeSize = max(1, int(amount))
+
+    def blockRng(self, block):
+        '''Random number generator of one block of poses'''
+        return np.random.default_rng(np.random.SeedSequence(self.seed, spawn_key=(int(block),)))
+
+    def unitCube(self, indices):
+        '''Points of the unit cube for the given pose indices'''
+        indices = np.asarray(indices, dtype=np.int64)
+
+        if self.method == 'halton':
+            #Cranley-Patterson rotation keeps the low discrepancy but depends on the seed
+            shift = np.random.default_rng(np.random.SeedSequence(self.seed)).random(3)
+            u = np.stack([radicalInverse(indices + 1, base) for base in HALTON_BASES], axis=1)
+            return np.mod(u + shift, 1.0)
+
+        u = np.empty((len(indices), 3), dtype=np.float64)
+
+        #Stratified blocks start at the run range
+        blockSize = self.blockSize
+        positions = indices
+        if self.method == 'stratified' and self.rangeSize is not None:
+            blockSize = self.rangeSize
+            positions = indices - self.rangeStart
+            if np.any(positions < 0):
+                raise ValueError('Pose index before the start of the stratified range')
+
+        blocks = positions // blockSize
+        offsets = positions % blockSize
+
+        for block in np.unique(blocks):
+            rng = self.blockRng(block)
+            selected = blocks == block
+
+            if self.method == 'random':
+                points = rng.random((blockSize, 3))
+            else:
+                #One sample per stratum in every dimension, strata shuffled per dimension
+                strata = np.stack([rng.permutation(blockSize) for _ in range(3)], axis=1)
+                points = (strata + rng.random((blockSize, 3))) / blockSize
+
+            u[selected] = points[offsets[selected]]
+
+        return u
+
+    def sample(self, indices):
+        '''Returns the (N,4) quaternions [w,x,y,z] of the given pose indices'''
+        return shoemake(self.unitCube(indices))
+
+    def batch(self, start, amount):
+        '''Returns the (amount,4) quaternions of the poses start..start+amount-1'''
+        return self.sample(np.arange(start, start + amount))
+
+    def __getitem__(self, index):
+        return self.sample([index])[0]
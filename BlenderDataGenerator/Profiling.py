@@ -0,0 +1,217 @@
+'''
+Per stage timing and memory watermarks of the data generation loop.
+
+Every frame records the wall time of its stages (render, segmentation, saving...),
+the summary gives the mean and 95th percentile per stage and the frame rate,
+the full trace can be written as CSV or JSON.
+
+MemoryMonitor samples the resident memory of the process and the number of
+blender datablocks every few frames, a long run should show a flat profile.
+'''
+import contextlib
+import csv
+import json
+import os
+import sys
+import time
+
+import numpy as np
+
+class StageTimer():
+    def __init__(self, enabled = True):
+        self.enabled = enabled
+        self.reset()
+
+    def reset(self):
+        '''Drops all recorded frames'''
+        self.frames = []
+        self.frameIndex = {}
+        self.current = None
+        self.frameStart = None
+        self.stages = []
+
+    def startFrame(self, index):
+        '''Starts recording the stages of frame index'''
+        if not self.enabled:
+            return
+        self.current = {'frame' : index}
+        self.frameStart = time.perf_counter()
+
+    @contextlib.contextmanager
+    def stage(self, name):
+        '''Context manager timing one stage of the current frame'''
+        if not self.enabled or self.current is None:
+            yield
+            return
+
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            #Stages that run several times in a frame add up
+            self.current[name] = self.current.get(name, 0.0) + time.perf_counter() - start
+            if name not in self.stages:
+                self.stages.append(name)
+
+    def endFrame(self):
+        '''Finishes the current frame and stores its timings'''
+        if not self.enabled or self.current is None:
+            return
+        self.current['total'] = time.perf_counter() - self.frameStart
+        self.frames.append(self.current)
+        self.frameIndex[self.current['frame']] = self.current
+        self.current = None
+
+    def addTime(self, index, name, seconds):
+        '''
+        Adds seconds measured somewhere else, e.g. by a worker thread, to stage name of
+        frame index, the frame can still be running or already finished
+        '''
+        if not self.enabled:
+            return
+
+        if self.current is not None and self.current['frame'] == index:
+            frame = self.current
+        else:
+            frame = self.frameIndex.get(index)
+        if frame is None:
+            return
+
+        frame[name] = frame.get(name, 0.0) + seconds
+        if name not in self.stages:
+            self.stages.append(name)
+
+    def summary(self):
+        '''
+        Returns a dictionary with the mean, 95th percentile and total seconds per stage,
+        the number of frames and the frames per second
+        '''
+        result = {'frames' : len(self.frames), 'fps' : 0.0, 'stages' : {}}
+        if not self.frames:
+            return result
+
+        for name in self.stages + ['total']:
+            times = np.array([frame.get(name, 0.0) for frame in self.frames])
+            result['stages'][name] = {'mean' : float(times.mean()),
+                                      'p95' : float(np.percentile(times, 95)),
+                                      'total' : float(times.sum())}
+
+        total = result['stages']['total']['total']
+        result['fps'] = len(self.frames) / total if total > 0 else 0.0
+
+        return result
+
+    def printSummary(self):
+        summary = self.summary()
+        if not summary['frames']:
+            return
+
+        print('{frames} frames, {fps:.2f} frames/sec'.format(**summary))
+        print('{0:<16}{1:>12}{2:>12}{3:>9}'.format('stage', 'mean [ms]', 'p95 [ms]', 'share'))
+        total = summary['stages']['total']['total']
+        for name, stats in summary['stages'].items():
+            share = stats['total'] / total if total > 0 else 0.0
+            print('{0:<16}{1:>12.2f}{2:>12.2f}{3:>8.1f}%'.format(name, 1000*stats['mean'],
+                                                             1000*stats['p95'], 100*share))
+
+    def dumpTrace(self, filePath):
+        '''Writes the per frame timings, CSV if the file ends with .csv otherwise JSON'''
+        if filePath.endswith('.csv'):
+            fields = ['frame'] + self.stages + ['total']
+            with open(filePath, 'w', newline='') as outfile:
+                writer = csv.DictWriter(outfile, fieldnames=fields, restval=0.0)
+                writer.writeheader()
+                writer.writerows(self.frames)
+        else:
+            with open(filePath, 'w+') as outfile:
+                json.dump({'summary' : self.summary(), 'frames' : self.frames}, outfile, indent=4)
+
+def residentMemory():
+    '''
+    Current resident set size of the process in bytes, uses psutil when it is installed,
+    /proc on linux and the peak resident size from resource otherwise
+    '''
+    try:
+        import psutil
+        return psutil.Process().memory_info().rss
+    except ImportError:
+        pass
+
+    try:
+        with open('/proc/self/statm') as infile:
+            return int(infile.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    except (OSError, ValueError, AttributeError):
+        pass
+
+    try:
+        import resource
+        peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        #Kilobytes on linux, bytes on macOS
+        return peak if sys.platform == 'darwin' else peak * 1024
+    except ImportError:
+        return None
+
+class MemoryMonitor():
+    def __init__(self, interval = 1000):
+        '''Samples the memory every interval frames, interval 0 disables the monitor'''
+        self.interval = interval
+        self.reset()
+
+    def reset(self):
+        self.samples = []
+
+    def due(self, frame):
+        '''True when frame should be sampled'''
+        return self.interval > 0 and frame % self.interval == 0
+
+    def sample(self, frame, counts = None):
+        '''
+        Records the resident memory and the given datablock counts (name -> count)
+        at frame and prints one line
+        '''
+        rss = residentMemory()
+        sample = {'frame' : frame, 'rss' : rss}
+        sample.update(counts or {})
+        self.samples.append(sample)
+
+        line = 'Frame {frame}: RSS {rss}'.format(frame=frame,
+                                                 rss='n/a' if rss is None else '{:.1f} MB'.format(rss / 2**20))
+        if counts:
+            line += ', ' + ', '.join('{0} {1}'.format(name, count) for name, count in counts.items())
+        print(line)
+
+        return sample
+
+    def summary(self):
+        '''
+        First, last and peak resident memory in bytes and the growth of the resident memory
+        and of every datablock count between the first and the last sample
+        '''
+        result = {'samples' : len(self.samples)}
+        rss = [sample['rss'] for sample in self.samples if sample['rss'] is not None]
+        if rss:
+            result.update({'first' : rss[0], 'last' : rss[-1], 'peak' : max(rss), 'growth' : rss[-1] - rss[0]})
+
+        if len(self.samples) > 1:
+            first, last = self.samples[0], self.samples[-1]
+            result['datablocks'] = {name : last[name] - first[name] for name in first
+                                    if name not in ('frame', 'rss') and name in last}
+
+        return result
+
+    def printSummary(self):
+        summary = self.summary()
+        if 'peak' not in summary:
+            return
+
+        print('Memory: peak {peak:.1f} MB, growth {growth:+.1f} MB over {samples} samples'.format(
+            peak=summary['peak'] / 2**20, growth=summary['growth'] / 2**20, samples=summary['samples']))
+
+        grown = {name : change for name, change in summary.get('datablocks', {}).items() if change}
+        if grown:
+            print('Datablock growth: ' + ', '.join('{0} {1:+d}'.format(name, change) for name, change in grown.items()))
+
+    def dump(self, filePath):
+        '''Writes the samples and the summary as JSON'''
+        with open(filePath, 'w+') as outfile:
+            json.dump({'summary' : self.summary(), 'samples' : self.samples}, outfile, indent=4)
@@ -0,0 +1,118 @@
+'''
+Vectorized projection helpers, these only use numpy so they can be used
+outside of blender as well (e.g. when re-annotating an existing dataset)
+
+Pixel coordinates follow the image convention used by the saved segmentation,
+0,0 is the top left of the image with y pointing down
+'''
+import numpy as np
+
+def matrixToArray(matrix):
+    '''Converts a mathutils.Matrix (or any nested sequence) into a numpy array'''
+    return np.array([list(row) for row in matrix], dtype=np.float64)
+
+def transformPoints(points, matrix):
+    '''
+    Applies a 4x4 transformation to an (N,3) array of points and returns
+    the (N,3) transformed points
+    '''
+    matrix = np.asarray(matrix, dtype=np.float64)
+    return points @ matrix[:3,:3].T + matrix[:3,3]
+
+def intrinsicsFromProjection(projection, resolution):
+    '''
+    Pinhole camera matrix K in pixels from a blender projection matrix
+
+    K is for camera coordinates with x right, y down and z forward (blender cameras look
+    down -z with y up) and matches the pixel convention of projectPoints
+    '''
+    res_x, res_y = resolution
+    projection = np.asarray(projection, dtype=np.float64)
+
+    return np.array([[0.5*res_x*projection[0,0], 0.0, 0.5*res_x*(1.0 - projection[0,2])],
+                     [0.0, 0.5*res_y*projection[1,1], 0.5*res_y*(1.0 + projection[1,2])],
+                     [0.0, 0.0, 1.0]])
+
+def projectPoints(points, matrix, resolution):
+    '''
+    Projects (N,3) world space points with a 4x4 projection @ view matrix
+
+    Returns the (N,2) pixel coordinates and the (N,) depth in front of the camera,
+    points with a depth <= 0 are behind the camera and their pixel coordinates
+    should be ignored
+    '''
+    matrix = np.asarray(matrix, dtype=np.float64)
+    res_x, res_y = resolution
+
+    #One matmul for all the points, homogeneous coordinates
+    clip = points @ matrix[:,:3].T + matrix[:,3]
+    depth = clip[:,3]
+
+    #Perspective division, avoid dividing by zero for points on the camera plane
+    with np.errstate(divide='ignore', invalid='ignore'):
+        ndc = clip[:,:2] / depth[:,None]
+
+    pixels = np.empty((len(points), 2), dtype=np.float64)
+    pixels[:,0] = (ndc[:,0] + 1.0) * 0.5 * res_x
+    pixels[:,1] = (1.0 - ndc[:,1]) * 0.5 * res_y
+
+    return pixels, depth
+
+def boundingBoxes(pixels, depth, offsets, resolution):
+    '''
+    Computes the 2D bounding box of every object from projected vertices
+
+    pixels and depth are the output of projectPoints for the vertices of all the
+    objects stacked together, offsets holds the index of the first vertex of each object
+
+    Returns a (K,4) array of COCO style boxes [x, y, width, height] clipped to the image,
+    rows of objects that are not in view are NaN
+    '''
+    offsets = np.asarray(offsets, dtype=np.int64)
+    count = len(pixels)
+    boxes = np.full((len(offsets), 4), np.nan)
+
+    if count == 0 or len(offsets) == 0:
+        return boxes
+
+    res_x, res_y = resolution
+
+    #Vertices behind the camera are ignored
+    inFront = depth > 0.0
+    x = pixels[:,0]
+    y = pixels[:,1]
+
+    #reduceat only runs over the starts of non empty objects, a segment then ends at the
+    #start of the next non empty object, the results are scattered back to every object
+    sizes = np.diff(np.append(offsets, count))
+    nonEmpty = sizes > 0
+    starts = offsets[nonEmpty]
+
+    min_x = np.full(len(offsets), np.inf)
+    max_x = np.full(len(offsets), -np.inf)
+    min_y = np.full(len(offsets), np.inf)
+    max_y = np.full(len(offsets), -np.inf)
+
+    if len(starts):
+        min_x[nonEmpty] = np.minimum.reduceat(np.where(inFront, x, np.inf), starts)
+        max_x[nonEmpty] = np.maximum.reduceat(np.where(inFront, x, -np.inf), starts)
+        min_y[nonEmpty] = np.minimum.reduceat(np.where(inFront, y, np.inf), starts)
+        max_y[nonEmpty] = np.maximum.reduceat(np.where(inFront, y, -np.inf), starts)
+
+    visible = nonEmpty & np.isfinite(min_x) & np.isfinite(min_y)
+
+    #Limit the values to the image
+    min_x = np.clip(min_x, 0.0, res_x)
+    max_x = np.clip(max_x, 0.0, res_x)
+    min_y = np.clip(min_y, 0.0, res_y)
+    max_y = np.clip(max_y, 0.0, res_y)
+
+    #Object is not in view if both bounding points exist on the same side
+    visible &= (max_x > min_x) & (max_y > min_y)
+
+    boxes[visible,0] = min_x[visible]
+    boxes[visible,1] = min_y[visible]
+    boxes[visible,2] = (max_x - min_x)[visible]
+    boxes[visible,3] = (max_y - min_y)[visible]
+
+    return boxes
@@ -0,0 +1,149 @@
+'''
+Domain randomization parameters sampled for a whole run in one numpy batch.
+
+Every parameter is drawn with PoseSampler.indexedRandom from its own stream, so
+the value of frame i only depends on the seed and i, sharded and resumed runs
+randomize a frame exactly the same way.
+
+Parameters that only touch transforms or light values (sun direction and strength,
+camera roll) change every frame. Parameters that make blender update shaders or
+the world lighting (world color and strength, material roughness, HDRI backdrops)
+are drawn per group of groupSize consecutive frames, the scene only changes when a
+new group starts so those updates are paid once per group instead of per frame.
+'''
+import os
+
+import numpy as np
+
+from .PoseSampler import indexedRandom
+
+#Random streams of the parameters, stream 1 is the camera distance (see Generator.sampleCameraDistances)
+STREAMS = {'sunDirection' : 2,
+           'sunStrength' : 3,
+           'cameraRoll' : 4,
+           'worldColor' : 5,
+           'worldStrength' : 6,
+           'roughness' : 7,
+           'hdri' : 8}
+
+def uniform(u, valueRange):
+    '''Scales uniform numbers in [0,1) to valueRange (low, high)'''
+    low, high = valueRange
+    return low + (high - low) * u
+
+def coneQuaternions(u, angle):
+    '''
+    (N,4) quaternions [w,x,y,z] rotating the z axis to directions uniformly distributed
+    over the spherical cap of the given half angle around it, u is (N,2) uniform numbers
+    '''
+    cosTheta = 1.0 - u[:,0] * (1.0 - np.cos(angle))
+    theta = np.arccos(np.clip(cosTheta, -1.0, 1.0))
+    phi = 2.0 * np.pi * u[:,1]
+
+    #Rotation by theta about the axis in the xy plane perpendicular to the direction
+    half = theta / 2.0
+    quaternions = np.empty((len(u), 4), dtype=np.float64)
+    quaternions[:,0] = np.cos(half)
+    quaternions[:,1] = -np.sin(phi) * np.sin(half)
+    quaternions[:,2] = np.cos(phi) * np.sin(half)
+    quaternions[:,3] = 0.0
+
+    return quaternions
+
+def multiplyQuaternions(a, b):
+    '''Hamilton product of (N,4) quaternions [w,x,y,z], rotates by b then by a'''
+    w1, x1, y1, z1 = a[:,0], a[:,1], a[:,2], a[:,3]
+    w2, x2, y2, z2 = b[:,0], b[:,1], b[:,2], b[:,3]
+
+    return np.stack([w1*w2 - x1*x2 - y1*y2 - z1*z2,
+                     w1*x2 + x1*w2 + y1*z2 - z1*y2,
+                     w1*y2 - x1*z2 + y1*w2 + z1*x2,
+                     w1*z2 + x1*y2 - y1*x2 + z1*w2], axis=1)
+
+class Randomizer():
+    def __init__(self, sunAngle = None, sunStrength = None, cameraDistance = None, cameraRoll = None,
+                 worldColor = None, worldStrength = None, roughness = None, hdris = None, groupSize = 64):
+        '''
+        Every parameter left as None is not randomized:
+        sunAngle       : half angle in radians of the cone around the view direction the sun comes from,
+                         0 keeps the sun locked to the camera
+        sunStrength    : (low, high) sun strength
+        cameraDistance : (low, high) multiples of the fitted camera distance
+        cameraRoll     : (low, high) roll of the camera around its view axis in radians
+        worldColor     : (low, high) of every channel of the background color
+        worldStrength  : (low, high) background or HDRI strength
+        roughness      : (low, high) roughness of every material of the model
+        hdris          : list of HDRI image files used as backdrop, one per group
+
+        groupSize is the number of consecutive frames sharing the world, roughness and HDRI
+        '''
+        self.sunAngle = sunAngle
+        self.sunStrength = sunStrength
+        self.cameraDistance = cameraDistance
+        self.cameraRoll = cameraRoll
+        self.worldColor = worldColor
+        self.worldStrength = worldStrength
+        self.roughness = roughness
+        self.hdris = list(hdris) if hdris else []
+        self.groupSize = max(1, int(groupSize))
+
+    def sample(self, seed, indices, poses):
+        '''
+        Parameters of the given frames as a dictionary of (N,...) arrays, poses holds the
+        (N,4) camera axis quaternions of the frames the sun direction is relative to
+        '''
+        indices = np.asarray(indices, dtype=np.int64)
+        groups = indices // self.groupSize
+        parameters = {}
+
+        if self.sunAngle is not None:
+            offsets = coneQuaternions(indexedRandom(seed, indices, 2, STREAMS['sunDirection']), self.sunAngle)
+            parameters['sunQuaternion'] = multiplyQuaternions(np.asarray(poses, dtype=np.float64), offsets)
+
+        if self.sunStrength is not None:
+            parameters['sunStrength'] = uniform(indexedRandom(seed, indices, 1, STREAMS['sunStrength'])[:,0],
+                                                self.sunStrength)
+
+        if self.cameraRoll is not None:
+            parameters['cameraRoll'] = uniform(indexedRandom(seed, indices, 1, STREAMS['cameraRoll'])[:,0],
+                                               self.cameraRoll)
+
+        #Shader and world parameters are drawn per group, every frame of a group gets the same value
+        if self.worldColor is not None and not self.hdris:
+            parameters['worldColor'] = uniform(indexedRandom(seed, groups, 3, STREAMS['worldColor']),
+                                               self.worldColor)
+
+        if self.worldStrength is not None:
+            parameters['worldStrength'] = uniform(indexedRandom(seed, groups, 1, STREAMS['worldStrength'])[:,0],
+                                                  self.worldStrength)
+
+        if self.roughness is not None:
+            parameters['roughness'] = uniform(indexedRandom(seed, groups, 1, STREAMS['roughness'])[:,0],
+                                              self.roughness)
+
+        if self.hdris:
+            u = indexedRandom(seed, groups, 2, STREAMS['hdri'])
+            parameters['hdri'] = np.minimum((u[:,0] * len(self.hdris)).astype(np.int64), len(self.hdris) - 1)
+            parameters['hdriRotation'] = 2.0 * np.pi * u[:,1]
+
+        return parameters
+
+    def record(self, parameters, row):
+        '''JSON friendly values of one frame for the annotation record'''
+        names = {'sunQuaternion' : 'sun_quaternion',
+                 'sunStrength' : 'sun_strength',
+                 'cameraRoll' : 'camera_roll',
+                 'worldColor' : 'world_color',
+                 'worldStrength' : 'world_strength',
+                 'roughness' : 'roughness',
+                 'hdriRotation' : 'hdri_rotation'}
+
+        record = {}
+        for name, values in parameters.items():
+            if name == 'hdri':
+                record['hdri'] = os.path.basename(self.hdris[int(values[row])])
+            else:
+                value = values[row]
+                record[names[name]] = value.tolist() if np.ndim(value) else float(value)
+
+        return record
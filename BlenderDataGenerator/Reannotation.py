@@ -0,0 +1,159 @@
+'''
+Re-annotation of an existing dataset without rendering.
+
+The stored quaternion, camera distance and camera roll of a record fully define
+where the camera was, so the camera matrices of all records are rebuilt with numpy
+and the geometric labels (bounding boxes, keypoints, translation, mask labels) are
+recomputed in parallel chunks. Only numpy is used in the workers, blender is only
+needed once to read the geometry and the camera projection (see Generator.reannotate).
+'''
+import json
+import multiprocessing
+import os
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+
+from . import Projection
+from . import Keypoints
+from .MaskStorage import MaskReader, maskStatistics
+from .TarExporter import ShardReader, decodeSample
+
+LABELS = ('bbox', 'keypoints', 'translation', 'mask_labels')
+
+def quaternionMatrices(quaternions):
+    '''(N,3,3) rotation matrices of (N,4) unit quaternions [w,x,y,z]'''
+    q = np.asarray(quaternions, dtype=np.float64)
+    q = q / np.linalg.norm(q, axis=1, keepdims=True)
+    w, x, y, z = q[:,0], q[:,1], q[:,2], q[:,3]
+
+    return np.stack([np.stack([1 - 2*(y*y + z*z), 2*(x*y - w*z), 2*(x*z + w*y)], axis=1),
+                     np.stack([2*(x*y + w*z), 1 - 2*(x*x + z*z), 2*(y*z - w*x)], axis=1),
+                     np.stack([2*(x*z - w*y), 2*(y*z + w*x), 1 - 2*(x*x + y*y)], axis=1)], axis=1)
+
+def viewMatrices(quaternions, distances, rolls, objectAxisMatrix):
+    '''
+    (N,4,4) world to camera matrices of the camera rig, the camera axis is rotated by
+    the quaternion under the object axis and the camera sits at (0, 0, distance) on it,
+    rolled around its view axis
+    '''
+    count = len(quaternions)
+    rolls = np.asarray(rolls, dtype=np.float64)
+
+    #Camera axis, rotation only
+    axis = np.tile(np.eye(4), (count, 1, 1))
+    axis[:,:3,:3] = quaternionMatrices(quaternions)
+
+    #Camera relative to its axis, translation along z and the roll around z
+    camera = np.tile(np.eye(4), (count, 1, 1))
+    camera[:,0,0] = np.cos(rolls)
+    camera[:,0,1] = -np.sin(rolls)
+    camera[:,1,0] = np.sin(rolls)
+    camera[:,1,1] = np.cos(rolls)
+    camera[:,2,3] = distances
+
+    world = np.asarray(objectAxisMatrix, dtype=np.float64) @ axis @ camera
+
+    return np.linalg.inv(world)
+
+def readMask(record, maskReader, shardReader):
+    '''Integer mask of a record from the mask files or from its tar shard, None when it is not available'''
+    if 'shard' in record:
+        if shardReader is None:
+            return None
+        shard = [entry['shard'] for entry in shardReader.shards].index(record['shard'])
+        key = record['segmentation_file'][:-len('.mask.npy')]
+        return decodeSample(shardReader.readSample(shard, key))['mask.npy']
+
+    return maskReader.read(record)
+
+def annotateChunk(job):
+    '''
+    Worker entry point, recomputes the labels of one chunk of records and returns
+    a list of (row, fields) with the new label fields of every record
+    '''
+    records = job['records']
+    labels = job['labels']
+    resolution = job['resolution']
+    projection = np.asarray(job['projection'], dtype=np.float64)
+    views = viewMatrices(job['quaternions'], job['distances'], job['rolls'], job['objectAxisMatrix'])
+
+    vertices = job.get('vertices')
+    keypoints = job.get('keypoints')
+
+    #Masks are only read for the labels that need them
+    needsMask = 'mask_labels' in labels or ('keypoints' in labels and keypoints is not None)
+    maskReader = MaskReader(job['annotationPath']) if needsMask else None
+    shardReader = ShardReader(job['shardPath']) if needsMask and job.get('shardPath') else None
+
+    results = []
+    for k, record in enumerate(records):
+        matrix = projection @ views[k]
+        fields = {}
+
+        if 'bbox' in labels and vertices is not None:
+            pixels, depth = Projection.projectPoints(vertices['points'], matrix, resolution)
+            boxes = Projection.boundingBoxes(pixels, depth, vertices['offsets'], resolution)
+            fields['bbox'] = {i+1 : box.tolist() for i, box in enumerate(boxes) if not np.isnan(box[0])}
+
+        if 'translation' in labels:
+            fields['translation'] = Keypoints.cameraTranslation(views[k], job['objectAxisMatrix'][:3,3])
+
+        mask = readMask(record, maskReader, shardReader) if needsMask else None
+
+        if 'keypoints' in labels and keypoints is not None:
+            pixels, depth = Projection.projectPoints(keypoints['points'], matrix, resolution)
+            #Without the mask the keypoints in the image are labeled but not known to be visible
+            height, width = resolution[1], resolution[0]
+            segmentation = np.asarray(mask) if mask is not None else np.zeros((height, width), dtype=np.uint8)
+            visibility = Keypoints.keypointVisibility(pixels, depth, keypoints['labels'],
+                                                      segmentation, job['keypointRadius'])
+            fields['keypoints'] = Keypoints.cocoKeypoints(pixels, visibility, keypoints['offsets'])
+
+        if 'mask_labels' in labels and mask is not None:
+            boxes = fields.get('bbox', record.get('bbox'))
+            if boxes is not None:
+                #Boxes read from json are keyed by strings
+                boxes = {int(label) : box for label, box in boxes.items()}
+            fields['mask_labels'] = maskStatistics(np.asarray(mask), job['numObjects'], boxes)
+
+        results.append((job['rows'][k], fields))
+
+    if maskReader is not None:
+        maskReader.close()
+
+    return results
+
+def runChunks(jobs, workers = None):
+    '''Runs the chunk jobs on a pool of worker processes, workers = 0 runs them in this process'''
+    if workers == 0 or len(jobs) <= 1:
+        return [annotateChunk(job) for job in jobs]
+
+    if workers is None:
+        workers = os.cpu_count() or 1
+
+    #Spawn so the workers do not inherit the blender state
+    context = multiprocessing.get_context('spawn')
+    with ProcessPoolExecutor(max_workers=min(workers, len(jobs)), mp_context=context) as pool:
+        return list(pool.map(annotateChunk, jobs))
+
+def writeAnnotation(annotationPath, records):
+    '''
+    Replaces annotation.json and the streamed annotation.jsonl with the updated records,
+    both are written to a temporary file first so a reader never sees half of them
+    '''
+    annotationFile = os.path.join(annotationPath, 'annotation.json')
+    temporaryfile = annotationFile + '.tmp'
+    with open(temporaryfile, 'w+') as outfile:
+        json.dump({'images' : records}, outfile, indent=4)
+    os.replace(temporaryfile, annotationFile)
+
+    streamFile = os.path.join(annotationPath, 'annotation.jsonl')
+    if os.path.isfile(streamFile):
+        temporaryfile = streamFile + '.tmp'
+        with open(temporaryfile, 'w+') as outfile:
+            for record in records:
+                outfile.write(json.dumps(record) + '\n')
+        os.replace(temporaryfile, streamFile)
+
+    return annotationFile
@@ -0,0 +1,115 @@
+'''
+Render quality presets for data generation.
+
+Every profile is a dictionary of settings grouped by the blender structure they
+belong to, 'render' is scene.render, 'cycles' is scene.cycles and 'view_layer'
+is the generator view layer.
+
+Every frame is saved with its segmentation, which uses the object index pass that
+is only rendered by cycles, so every profile renders with cycles.
+'''
+import copy
+
+PROFILES = {
+    #Quick previews, noisy but an order of magnitude faster than the defaults
+    'fast' : {
+        'engine' : 'CYCLES',
+        'render' : {'resolution_percentage' : 50,
+                    'use_persistent_data' : True},
+        'cycles' : {'samples' : 16,
+                    'use_adaptive_sampling' : True,
+                    'adaptive_threshold' : 0.1,
+                    'use_denoising' : False,
+                    'max_bounces' : 2,
+                    'diffuse_bounces' : 1,
+                    'glossy_bounces' : 1,
+                    'transmission_bounces' : 1,
+                    'volume_bounces' : 0,
+                    'transparent_max_bounces' : 2,
+                    'tile_size' : 2048},
+    },
+
+    'balanced' : {
+        'engine' : 'CYCLES',
+        'render' : {'resolution_percentage' : 100,
+                    'use_persistent_data' : True},
+        'cycles' : {'samples' : 64,
+                    'use_adaptive_sampling' : True,
+                    'adaptive_threshold' : 0.05,
+                    'use_denoising' : True,
+                    'max_bounces' : 4,
+                    'diffuse_bounces' : 2,
+                    'glossy_bounces' : 2,
+                    'transmission_bounces' : 2,
+                    'volume_bounces' : 0,
+                    'transparent_max_bounces' : 4,
+                    'tile_size' : 2048},
+    },
+
+    'final' : {
+        'engine' : 'CYCLES',
+        'render' : {'resolution_percentage' : 100,
+                    'use_persistent_data' : True},
+        'cycles' : {'samples' : 256,
+                    'use_adaptive_sampling' : True,
+                    'adaptive_threshold' : 0.01,
+                    'use_denoising' : True,
+                    'max_bounces' : 12,
+                    'diffuse_bounces' : 4,
+                    'glossy_bounces' : 4,
+                    'transmission_bounces' : 12,
+                    'volume_bounces' : 0,
+                    'transparent_max_bounces' : 8,
+                    'tile_size' : 2048},
+    },
+
+    #Only the object index pass, one sample and no light paths
+    'mask' : {
+        'engine' : 'CYCLES',
+        'maskOnly' : True,
+        'render' : {'use_persistent_data' : True},
+        'cycles' : {'samples' : 1,
+                    'use_adaptive_sampling' : False,
+                    'use_denoising' : False,
+                    'max_bounces' : 0,
+                    'diffuse_bounces' : 0,
+                    'glossy_bounces' : 0,
+                    'transmission_bounces' : 0,
+                    'volume_bounces' : 0,
+                    'transparent_max_bounces' : 0,
+                    'tile_size' : 2048},
+        'view_layer' : {'use_pass_combined' : False},
+    },
+}
+
+def getProfile(name, **overrides):
+    '''
+    Returns a copy of a profile, overrides are merged into the setting groups,
+    e.g. getProfile('fast', cycles={'samples' : 8})
+    '''
+    if name not in PROFILES:
+        raise ValueError('Unknown render profile: ' + str(name))
+
+    profile = copy.deepcopy(PROFILES[name])
+    for group, settings in overrides.items():
+        if isinstance(settings, dict):
+            profile.setdefault(group, {}).update(settings)
+        else:
+            profile[group] = settings
+
+    return profile
+
+def applySettings(target, settings):
+    '''
+    Sets every attribute of settings on a blender structure, settings that do not
+    exist in the running blender version are skipped
+    '''
+    skipped = []
+    for attribute, value in settings.items():
+        if hasattr(target, attribute):
+            setattr(target, attribute, value)
+        else:
+            skipped.append(attribute)
+
+    if skipped:
+        print('Render settings not available in this blender version: ' + ', '.join(skipped))
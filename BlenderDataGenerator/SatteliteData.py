@@ -1,59 +1,68 @@
 import bpy
 import numpy as np
 import mathutils
-import math
 import json
 
-import os, shutil
+import os, shutil, glob
+import hashlib
+import io
+import time
+
+from . import Projection
+from .AnnotationWriter import AnnotationWriter
+from .MaskStorage import MaskWriter, MaskReader, maskDtype, toIntegerMask, maskStatistics, maskFormatOf
+from .PoseSampler import PoseSampler, shoemake, indexedRandom
+from . import Framing
+from . import Keypoints
+from . import Reannotation
+from .Randomization import Randomizer
+from . import RenderProfiles
+from .Profiling import StageTimer, MemoryMonitor
+from .Pipeline import OrderedPipeline
+
+#Ground truth passes that can be captured next to the segmentation,
+#name -> (view layer setting, render layers output, channels kept)
+RENDER_PASSES = {'Depth' : ('use_pass_z', 'Depth', 1),
+                 'Normal' : ('use_pass_normal', 'Normal', 3)}
 
 class Generator():
-    def __init__(self, filePath = None, objectFilePath = None):
+    def __init__(self, filePath = None, objectFilePath = None, segmentationMode = 'memory', seed = None,
+                 sceneCachePath = None):
         '''
         Constructor, set the objects or multiple objects if there are any
-        '''
 
-        #Use this setting to setup blank workspace'''
-        bpy.ops.wm.read_factory_settings(use_empty=True)
-    
-        bpy.ops.world.new()
+        segmentationMode selects how the IndexOB pass is read back after a render,
+        'memory' reads the compositor viewer image directly, 'exr' writes and reloads
+        a temporary EXR file
 
-        # self.data = bpy.data
-        # self.context = bpy.context
+        seed is passed to numpy default_rng so runs can be reproduced
 
-        #Current scene
-        self.scene = bpy.context.scene
-        
-        #Create anchor points for the objects
-        self.ObjectAxis = bpy.data.objects.new(name='ObjectAxis', object_data=None)
-        self.scene.collection.objects.link(self.ObjectAxis)
+        sceneCachePath is a directory where the prepared scene of every model is saved,
+        later runs with the same model open the .blend instead of rebuilding the scene
+        and importing the obj again
+        '''
+        if segmentationMode not in ('memory', 'exr'):
+            raise ValueError('Unknown segmentation mode: ' + str(segmentationMode))
 
-        #Create anchor points for the camera axis
-        self.CameraAxis = bpy.data.objects.new(name='CameraAxis', object_data=None)
-        self.scene.collection.objects.link(self.CameraAxis)
-        self.CameraAxis.parent = self.ObjectAxis
-        self.CameraAxis.rotation_mode = 'QUATERNION'
-        self.CameraAxis.rotation_quaternion = (1,0,0,0)
+        #Prepared scenes are cached per model as .blend files when a cache path is given
+        self.sceneCacheFile = None
+        self.sceneCached = False
 
-        #https://blender.stackexchange.com/questions/151319/adding-camera-to-scene
-        cameraData = bpy.data.cameras.new(name='Camera')
-        self.Camera = bpy.data.objects.new('Camera', cameraData)
-        self.scene.collection.objects.link(self.Camera)
-        self.Camera.parent = self.CameraAxis
-        self.cameraDistance = 0
-        
-        #Set the scene camera to the newly added camera
-        self.scene.camera = bpy.data.objects['Camera']
+        if objectFilePath and sceneCachePath:
+            os.makedirs(sceneCachePath, exist_ok=True)
+            self.sceneCacheFile = self.sceneCacheName(sceneCachePath, objectFilePath)
 
-        #Adding Sun lighting
-        lightingData= bpy.data.lights.new(name='Sun', type='SUN')
-        self.lighting = bpy.data.objects.new('Sun', lightingData)
-        self.scene.collection.objects.link(self.lighting)
-        self.lighting.parent = self.ObjectAxis
-        self.lighting.rotation_mode = 'QUATERNION'
-        self.lighting.rotation_quaternion = (1,0,0,0)
+        if self.sceneCacheFile and os.path.isfile(self.sceneCacheFile):
+            self.loadScene(self.sceneCacheFile)
+        else:
+            self.buildScene()
 
         #Random number generator
-        self.rng = np.random.default_rng()
+        self.seed = seed
+        self.rng = np.random.default_rng(seed)
+
+        #Camera orientations, pose i only depends on the seed and i
+        self.poseSampler = PoseSampler(seed=seed)
 
         #define file path if given
         #can use bpy.path.abspath("//") but this seems a bit cleaner and reliable
@@ -94,12 +103,68 @@ class Generator():
         print(self.annotationFilePath)
         print(self.tempFilePath)
 
+        #How the segmentation is read back, see setSegmentationNodes
+        self.segmentationMode = segmentationMode
+
+        #Preallocated float32 buffer for the in memory segmentation, sized on first use
+        self.segmentationBuffer = None
+
+        #Passes captured from the same render as the segmentation, see setSegmentationNodes
+        self.extraPasses = []
+
+        #Bounding box, area, centroid and bounding box coverage of every object measured on the mask
+        self.maskLabels = True
+
+        #Only the segmentation is rendered and saved when set, see setRenderProfile
+        self.maskOnly = False
+
+        #Wall time of every stage of every frame in generateData
+        self.timer = StageTimer()
+
+        #Resident memory and datablock counts, sampled by generateData every memoryInterval frames
+        self.memory = MemoryMonitor(interval=0)
+
+        #Image datablocks of the EXR files read by loadData, reloaded instead of loaded again
+        self.loadedImages = {}
+
         #self._cleanFolder(self.tempFilePath)
 
-        #Import Object
-        self.objects = None
+        #Import Object, objects are already set by buildScene or loadScene
+
+        #Imported models of this session, keyed by file path, see importObject
+        self.library = {}
+
+        #Extra camera rigs rendered together as views of one render, see setViews
+        self.viewRigs = []
+
+        #Bounding box and pivot radius of every model, keyed by its object names
+        self.framingCache = {}
+
+        #How findCameraDistance fits the objects into view, see Framing.fitDistance
+        self.framingMode = 'sphere'
+
+        #World space vertices of all the objects, built once by cacheVertices
+        self.vertexCache = None
 
-        if objectFilePath:
+        #Domain randomization of the scene per frame, see setRandomization
+        self.randomizer = None
+        self.appliedRandomization = {}
+        self.hdriImages = []
+
+        #Scene values before randomization, restored when it is turned off or changed
+        self.randomizationDefaults = None
+
+        #3D keypoints of every model keyed by its object names, see setKeypoints
+        self.keypointSource = None
+        self.keypointCount = 8
+        self.landmarks = {}
+        self.keypointRadius = 2
+        self.keypointCache = {}
+
+        if objectFilePath and self.sceneCached:
+            self.library[objectFilePath] = self.objects
+
+        elif objectFilePath:
             bpy.ops.import_scene.obj(filepath=objectFilePath)
 
             #All imported objects are listed under selected after importing
@@ -120,6 +185,8 @@ class Generator():
             
             self.Camera.location = (0, 0, self.cameraDistance)
 
+            self.library[objectFilePath] = self.objects
+
         print(bpy.context.selected_objects)
 
         # print(self.scene.render.filepath)
@@ -130,36 +197,353 @@ class Generator():
         # instead of relying on bpy.context and active objects
         #self.ops.object.select_all(action='DESELECT')
 
+    def buildScene(self):
+        '''
+        Resets blender and creates the world, the object and camera axis, the camera and the sun
+        '''
+        #Use this setting to setup blank workspace'''
+        bpy.ops.wm.read_factory_settings(use_empty=True)
+    
+        bpy.ops.world.new()
+
+        # self.data = bpy.data
+        # self.context = bpy.context
+
+        #Current scene
+        self.scene = bpy.context.scene
+        
+        #Create anchor points for the objects
+        self.ObjectAxis = bpy.data.objects.new(name='ObjectAxis', object_data=None)
+        self.scene.collection.objects.link(self.ObjectAxis)
+
+        #Create anchor points for the camera axis
+        self.CameraAxis = bpy.data.objects.new(name='CameraAxis', object_data=None)
+        self.scene.collection.objects.link(self.CameraAxis)
+        self.CameraAxis.parent = self.ObjectAxis
+        self.CameraAxis.rotation_mode = 'QUATERNION'
+        self.CameraAxis.rotation_quaternion = (1,0,0,0)
+
+        #https://blender.stackexchange.com/questions/151319/adding-camera-to-scene
+        cameraData = bpy.data.cameras.new(name='Camera')
+        self.Camera = bpy.data.objects.new('Camera', cameraData)
+        self.scene.collection.objects.link(self.Camera)
+        self.Camera.parent = self.CameraAxis
+        
+        #Set the scene camera to the newly added camera
+        self.scene.camera = bpy.data.objects['Camera']
+
+        #Adding Sun lighting
+        lightingData= bpy.data.lights.new(name='Sun', type='SUN')
+        self.lighting = bpy.data.objects.new('Sun', lightingData)
+        self.scene.collection.objects.link(self.lighting)
+        self.lighting.parent = self.ObjectAxis
+        self.lighting.rotation_mode = 'QUATERNION'
+        self.lighting.rotation_quaternion = (1,0,0,0)
+
+        self.cameraDistance = 0
+        self.objects = None
+
+    def sceneCacheName(self, sceneCachePath, objectFilePath):
+        '''
+        File name of the cached scene of a model, the hash changes when the obj file changes
+        '''
+        stat = os.stat(objectFilePath)
+        key = '{path}|{mtime}|{size}'.format(path=os.path.abspath(objectFilePath),
+                                             mtime=stat.st_mtime_ns, size=stat.st_size)
+        digest = hashlib.sha1(key.encode('utf-8')).hexdigest()[:12]
+        name = os.path.splitext(os.path.basename(objectFilePath))[0]
+
+        return os.path.join(sceneCachePath, '{name}_{digest}.blend'.format(name=name, digest=digest))
+
+    def loadScene(self, sceneFile):
+        '''
+        Opens a scene saved by saveScene and binds the rig and the objects again
+        '''
+        bpy.ops.wm.open_mainfile(filepath=sceneFile, load_ui=False)
+
+        self.scene = bpy.context.scene
+        self.ObjectAxis = bpy.data.objects['ObjectAxis']
+        self.CameraAxis = bpy.data.objects['CameraAxis']
+        self.Camera = bpy.data.objects['Camera']
+        self.lighting = bpy.data.objects['Sun']
+        self.scene.camera = self.Camera
+
+        #Object order decides the pass index so it is stored with the scene
+        self.objects = [bpy.data.objects[name] for name in self.scene['generatorObjects']]
+        self.cameraDistance = self.scene['generatorCameraDistance']
+
+        self.sceneCached = True
+        print('Loaded cached scene: ' + sceneFile)
+
+    def saveScene(self, sceneFile = None):
+        '''
+        Saves the prepared scene (rig, objects and compositor nodes) as a .blend file
+        '''
+        if sceneFile is None:
+            sceneFile = self.sceneCacheFile
+
+        self.scene['generatorObjects'] = [obj.name for obj in self.objects]
+        self.scene['generatorCameraDistance'] = self.cameraDistance
+
+        #copy keeps the current session pointed at its own file
+        bpy.ops.wm.save_as_mainfile(filepath=sceneFile, copy=True)
+        print('Saved scene: ' + sceneFile)
+
+    def updateSceneCache(self):
+        '''Saves the scene cache once the scene is fully prepared, if it was built from scratch'''
+        if self.sceneCacheFile and not self.sceneCached:
+            self.saveScene()
+            self.sceneCached = True
+
     def setFilePaths(self):
         pass
     
-    def importObject(self, objectFilePath):
+    def importObject(self, objectFilePath, keep = True):
         '''
         Setter function for importing the object from an object file and setting the objects list
+
+        With keep the current objects are only hidden and stay in the session library,
+        importing the same file again swaps them back in instead of running the obj importer
         '''
         if self.objects:
             # bpy.ops.object.select_all(action='DESELECT')
-            for obj in self.objects:
-                bpy.data.objects.remove(obj, do_unlink = True)
-        
+            if keep:
+                self.setObjectsHidden(self.objects, True)
+            else:
+                for path, objects in list(self.library.items()):
+                    if objects is self.objects:
+                        del self.library[path]
+                self.framingCache.pop(tuple(obj.name for obj in self.objects), None)
+                self.keypointCache.pop(tuple(obj.name for obj in self.objects), None)
+                for obj in self.objects:
+                    bpy.data.objects.remove(obj, do_unlink = True)
+
+        if objectFilePath in self.library:
+            objects = self.library[objectFilePath]
+            self.setObjectsHidden(objects, False)
+        else:
+            bpy.ops.import_scene.obj(filepath=objectFilePath)
+            #All imported objects are listed under selected after importing
+            objects = bpy.context.selected_objects
 
-        bpy.ops.import_scene.obj(filepath=objectFilePath)
-        #All imported objects are listed under selected after importing
-        self.objects = bpy.context.selected_objects
+            self.library[objectFilePath] = objects
+
+        self.setObjects(objects)
+
+    def setObjects(self, objects):
+        '''
+        Uses objects that already exist in the scene, e.g. procedurally generated meshes,
+        parents them to the object axis and fits the camera distance
+        '''
+        self.objects = objects
 
         for object in self.objects:
             object.parent = self.ObjectAxis
-        
+
+        #Pass indices are shared between models, only the visible ones render
+        for i,obj in enumerate(self.objects):
+            obj.pass_index = i+1
+
+        #Vertices belong to the previous objects, cleared before the framing would use them
+        self.vertexCache = None
+
+        self.cameraDistance = self.findCameraDistance(self.Camera, self.objects)
+        self.Camera.location = (0, 0, self.cameraDistance)
+
+        #View cameras of a multi view render sit at the same distance
+        for rigAxis, rigCamera, suffix in self.viewRigs:
+            rigCamera.location = (0, 0, self.cameraDistance)
+
+    def setObjectsHidden(self, objects, hidden):
+        '''Hides or shows objects in the viewport and the render'''
+        for obj in objects:
+            obj.hide_render = hidden
+            obj.hide_viewport = hidden
 
     def randomQuaternion(self):
-        '''Generate a random quaternion with uniformly distributed orientations'''
-        w = self.rng.uniform(-1, 1)
-        x, y, z = self.rng.uniform(-1, 1, size=3)
-        mag = np.sqrt(w**2 + x**2 + y**2 + z**2)
-        quat = np.array([w, x/mag, y/mag, z/mag])
+        '''Generate a random unit quaternion with uniformly distributed orientations'''
+        return shoemake(self.rng.random((1, 3)))[0]
 
-        return quat
+    def setPoseSampler(self, method = 'random', seed = None, **kwargs):
+        '''
+        Replaces the pose sampler used by generateData, see PoseSampler for the methods,
+        the generator seed is used when seed is empty
+        '''
+        if seed is None:
+            seed = self.seed
+        self.poseSampler = PoseSampler(seed=seed, method=method, **kwargs)
+        return self.poseSampler
     
+    def setRandomization(self, **settings):
+        '''
+        Randomizes the scene of every frame, the settings are the parameters of
+        Randomization.Randomizer (sunAngle, sunStrength, cameraDistance, cameraRoll,
+        worldColor, worldStrength, roughness, hdris, groupSize), no settings disables it
+
+        The sun strength, world and roughness of the scene are restored to their values
+        from before randomization whenever it is turned off or set again
+        '''
+        self.restoreRandomization()
+        self.appliedRandomization = {}
+
+        if not settings:
+            self.randomizer = None
+            return None
+
+        self.randomizer = Randomizer(**settings)
+
+        world = self.scene.world
+        self.randomizationDefaults = {'sunStrength' : self.lighting.data.energy,
+                                      'world' : world,
+                                      'roughness' : {}}
+        if world is not None:
+            self.randomizationDefaults['useNodes'] = world.use_nodes
+            if world.node_tree is not None:
+                #Nodes added by setWorldNodes are removed again, the background keeps its values
+                nodes = world.node_tree.nodes
+                self.randomizationDefaults['worldNodes'] = {node.name for node in nodes}
+                if 'Background' in nodes:
+                    background = nodes['Background']
+                    self.randomizationDefaults['worldColor'] = tuple(background.inputs['Color'].default_value)
+                    self.randomizationDefaults['worldStrength'] = background.inputs['Strength'].default_value
+
+        if self.randomizer.hdris or self.randomizer.worldColor is not None or self.randomizer.worldStrength is not None:
+            self.setWorldNodes()
+
+        #HDRIs are loaded once, switching a backdrop only swaps the image of the texture node
+        self.hdriImages = [bpy.data.images.load(path, check_existing=True) for path in self.randomizer.hdris]
+
+        return self.randomizer
+
+    def restoreRandomization(self):
+        '''Puts the sun strength, world and material roughness back to their values from before randomization'''
+        defaults = self.randomizationDefaults
+        if defaults is None:
+            return
+
+        self.lighting.data.energy = defaults['sunStrength']
+
+        world = defaults['world']
+        self.scene.world = world
+        if world is not None:
+            if world.node_tree is not None and 'worldNodes' in defaults:
+                nodes = world.node_tree.nodes
+                for node in [node for node in nodes if node.name not in defaults['worldNodes']]:
+                    nodes.remove(node)
+                if 'worldColor' in defaults:
+                    nodes['Background'].inputs['Color'].default_value = defaults['worldColor']
+                    nodes['Background'].inputs['Strength'].default_value = defaults['worldStrength']
+            world.use_nodes = defaults['useNodes']
+
+        #Materials are looked up by name, the model may have been replaced since
+        for (materialName, nodeName), value in defaults['roughness'].items():
+            material = bpy.data.materials.get(materialName)
+            if material is not None and material.node_tree is not None and nodeName in material.node_tree.nodes:
+                material.node_tree.nodes[nodeName].inputs['Roughness'].default_value = value
+
+        self.randomizationDefaults = None
+
+    def setWorldNodes(self):
+        '''
+        Background node of the world and, for HDRI backdrops, an environment texture
+        with a mapping node for its rotation
+        '''
+        world = self.scene.world
+        if world is None:
+            world = bpy.data.worlds[0] if bpy.data.worlds else bpy.data.worlds.new('World')
+            self.scene.world = world
+
+        world.use_nodes = True
+        nodes = world.node_tree.nodes
+        links = world.node_tree.links
+
+        background = nodes.get('Background')
+        if background is None:
+            background = nodes.new(type='ShaderNodeBackground')
+            output = nodes.get('World Output') or nodes.new(type='ShaderNodeOutputWorld')
+            links.new(background.outputs['Background'], output.inputs['Surface'])
+
+        if not self.randomizer.hdris or 'Environment' in nodes:
+            return
+
+        environment = nodes.new(type='ShaderNodeTexEnvironment')
+        environment.name = 'Environment'
+        mapping = nodes.new(type='ShaderNodeMapping')
+        mapping.name = 'EnvironmentMapping'
+        coordinates = nodes.new(type='ShaderNodeTexCoord')
+
+        links.new(coordinates.outputs['Generated'], mapping.inputs['Vector'])
+        links.new(mapping.outputs['Vector'], environment.inputs['Vector'])
+        links.new(environment.outputs['Color'], background.inputs['Color'])
+
+    def roughnessSockets(self):
+        '''(material, principled shader) of every material of the model, the shaders hold the roughness input'''
+        sockets = []
+        materials = {slot.material for obj in self.objects for slot in getattr(obj, 'material_slots', []) if slot.material}
+        for material in materials:
+            if not material.use_nodes:
+                continue
+            for node in material.node_tree.nodes:
+                if node.type == 'BSDF_PRINCIPLED':
+                    sockets.append((material, node))
+        return sockets
+
+    def setGroupParameter(self, name, value, apply):
+        '''Applies a per group parameter only when its value changed, so shaders and the world only update once per group'''
+        if self.appliedRandomization.get(name) == value:
+            return
+        apply(value)
+        self.appliedRandomization[name] = value
+
+    def applyRandomization(self, parameters, row):
+        '''
+        Applies the per batch parameters of frame row to the sun, the world and the materials,
+        the camera roll is set per view by generateData
+        '''
+        if 'sunQuaternion' in parameters:
+            self.lighting.rotation_quaternion = mathutils.Quaternion(parameters['sunQuaternion'][row])
+
+        if 'sunStrength' in parameters:
+            self.lighting.data.energy = float(parameters['sunStrength'][row])
+
+        if self.scene.world is not None and self.scene.world.use_nodes:
+            nodes = self.scene.world.node_tree.nodes
+
+            def setWorldColor(value):
+                nodes['Background'].inputs['Color'].default_value = value
+
+            def setWorldStrength(value):
+                nodes['Background'].inputs['Strength'].default_value = value
+
+            def setHdri(value):
+                nodes['Environment'].image = self.hdriImages[value]
+
+            def setHdriRotation(value):
+                nodes['EnvironmentMapping'].inputs['Rotation'].default_value[2] = value
+
+            if 'worldColor' in parameters:
+                self.setGroupParameter('worldColor', tuple(parameters['worldColor'][row].tolist()) + (1.0,), setWorldColor)
+
+            if 'worldStrength' in parameters:
+                self.setGroupParameter('worldStrength', float(parameters['worldStrength'][row]), setWorldStrength)
+
+            if 'hdri' in parameters:
+                self.setGroupParameter('hdri', int(parameters['hdri'][row]), setHdri)
+
+            if 'hdriRotation' in parameters:
+                self.setGroupParameter('hdriRotation', float(parameters['hdriRotation'][row]), setHdriRotation)
+
+        if 'roughness' in parameters:
+            def setRoughness(value):
+                defaults = self.randomizationDefaults['roughness']
+                for material, node in self.roughnessSockets():
+                    #The value of a material is kept the first time it is randomized
+                    socket = node.inputs['Roughness']
+                    defaults.setdefault((material.name, node.name), socket.default_value)
+                    socket.default_value = value
+
+            self.setGroupParameter('roughness', float(parameters['roughness'][row]), setRoughness)
+
     def getResolution(self):
         '''Utility function used for camera resolution'''
         resolution_scale = (self.scene.render.resolution_percentage / 100.0)
@@ -167,6 +551,41 @@ class Generator():
         resolution_y = self.scene.render.resolution_y * resolution_scale # [pixels]
         return int(resolution_x), int(resolution_y)
     
+    def setRenderProfile(self, name = 'balanced', resolution = None, **overrides):
+        '''
+        Configures the render engine, samples, bounces, denoising, tiles and persistent data
+        in one call from the presets in RenderProfiles ('fast', 'balanced', 'final' or 'mask')
+
+        overrides are merged into the preset, e.g. cycles={'samples' : 8},
+        the 'mask' profile only renders and saves the segmentation
+        '''
+        profile = RenderProfiles.getProfile(name, **overrides)
+
+        #The object index pass of the segmentation is only rendered by cycles
+        if profile['engine'] != 'CYCLES':
+            raise ValueError('Render profiles have to use CYCLES, the segmentation needs the object index pass')
+
+        self.scene.render.engine = profile['engine']
+
+        if resolution:
+            self.scene.render.resolution_x = resolution[0]
+            self.scene.render.resolution_y = resolution[1]
+
+        #Persistent data keeps the BVH and scene data between the renders of generateData
+        RenderProfiles.applySettings(self.scene.render, profile.get('render', {}))
+        if 'cycles' in profile:
+            RenderProfiles.applySettings(self.scene.cycles, profile['cycles'])
+
+        viewLayer = self.scene.view_layers['ViewLayer']
+        #The combined pass is needed again when switching away from the mask profile
+        RenderProfiles.applySettings(viewLayer, {'use_pass_combined' : True})
+        if 'view_layer' in profile:
+            RenderProfiles.applySettings(viewLayer, profile['view_layer'])
+
+        self.maskOnly = profile.get('maskOnly', False)
+
+        print('Render profile: ' + name)
+
     def cleanFolder(self, folderPath):
         '''
         Utility function to clear folder and files if it exist,
@@ -191,20 +610,61 @@ class Generator():
     def loadData(self, filePath):
         '''
         Utility function used to load array data from temporary exr file
+
+        Every file path keeps one image datablock which is reloaded on the next read,
+        so long runs do not pile up images in bpy.data.images
         '''
         # Possible workaround for future
         # https://blender.stackexchange.com/questions/2170/how-to-access-render-result-pixels-from-python-script/248543#248543
         if not os.path.isfile(filePath):
             return None
-        
-        data = bpy.data.images.load(filePath)
+
+        data = self.loadedImages.get(filePath)
+        if data is None or data.name not in bpy.data.images:
+            data = bpy.data.images.load(filePath)
+            self.loadedImages[filePath] = data
+        else:
+            data.reload()
 
         #Pixels coordinates are usually 0,0 starting top left, 
         #instead of the usual 0,0 bottom left known in math and graphs
         #https://blender.stackexchange.com/questions/471/is-it-possible-to-make-blender-a-y-up-world
-        pixels = np.array(data.pixels)
         res_x, res_y = self.getResolution()
-        pixels.resize((res_y, res_x, 4)) #(y, x, channels)
+        pixels = np.empty(res_x * res_y * 4, dtype=np.float32)
+        data.pixels.foreach_get(pixels)
+        pixels = pixels.reshape((res_y, res_x, 4)) #(y, x, channels)
+        pixels = np.flip(pixels, 0) # Flip the y axis
+
+        return pixels
+
+    def releaseImages(self):
+        '''Removes the image datablocks created by loadData'''
+        for data in self.loadedImages.values():
+            if data.name in bpy.data.images:
+                bpy.data.images.remove(data)
+        self.loadedImages = {}
+
+    def datablockCounts(self):
+        '''Number of blender datablocks of the kinds that grow when something leaks'''
+        return {name : len(getattr(bpy.data, name)) for name in ('images', 'meshes', 'objects', 'materials', 'node_groups')}
+
+    def readViewer(self, image):
+        '''
+        Utility function used to copy the pixels of an image datablock straight into
+        a preallocated float32 buffer, avoids the temporary exr file entirely
+        '''
+        res_x, res_y = self.getResolution()
+        size = res_x * res_y * 4
+
+        #Only reallocate when the resolution changes
+        if self.segmentationBuffer is None or self.segmentationBuffer.size != size:
+            self.segmentationBuffer = np.empty(size, dtype=np.float32)
+
+        #foreach_get copies the whole buffer in C instead of building a python sequence
+        #https://blender.stackexchange.com/questions/2170/how-to-access-render-result-pixels-from-python-script/248543#248543
+        image.pixels.foreach_get(self.segmentationBuffer)
+
+        pixels = self.segmentationBuffer.reshape((res_y, res_x, 4)) #(y, x, channels)
         pixels = np.flip(pixels, 0) # Flip the y axis
 
         return pixels
@@ -212,37 +672,41 @@ class Generator():
     def saveData(self):
         pass
 
-    def findCameraDistance(self, cameraArg, objectArg):
+    def getFraming(self, objectArg = None):
+        '''
+        World space bounding box and pivot radius of the objects, computed once per model
+
+        Uses the cached vertices when they exist, otherwise the bound_box corners
+        '''
+        if objectArg is None:
+            objectArg = self.objects
+
+        key = tuple(obj.name for obj in objectArg)
+        if key not in self.framingCache:
+            if objectArg is self.objects and self.vertexCache is not None and len(self.vertexCache['points']):
+                points = self.vertexCache['points']
+            else:
+                points = Framing.boundBoxCorners(objectArg)
+
+            #The camera rig rotates around the object axis
+            pivot = Projection.matrixToArray(self.ObjectAxis.matrix_world)[:3,3]
+            self.framingCache[key] = Framing.computeFraming(points, pivot)
+
+        return self.framingCache[key]
+
+    def findCameraDistance(self, cameraArg, objectArg, mode = None):
         '''
         Function to return the distance for the camera to fit everything in view
+
+        mode 'sphere' keeps every part in view for any rotation of the rig,
+        'box' fits the 3D diagonal of the bounding box, see Framing.fitDistance
         '''
-        bbox_min = mathutils.Vector((float("inf"), float("inf"), float("inf")))
-        bbox_max = mathutils.Vector((float("-inf"), float("-inf"), float("-inf")))
-
-        #determine the max and min of the bounding boxs, use matrix_world to convert from model to global space
-        for obj in objectArg:
-            bbox = obj.bound_box
-            for i in range(8):
-                v = obj.matrix_world @ mathutils.Vector((bbox[i][0], bbox[i][1], bbox[i][2]))
-                bbox_min.x = min(bbox_min.x, v.x)
-                bbox_min.y = min(bbox_min.y, v.y)
-                bbox_min.z = min(bbox_min.z, v.z)
-                bbox_max.x = max(bbox_max.x, v.x)
-                bbox_max.y = max(bbox_max.y, v.y)
-                bbox_max.z = max(bbox_max.z, v.z)
-                
-        bbox = (bbox_min, bbox_max)
-
-        #ignore these as they were done for testing and learning purposes
-        #center = (bbox[1] + bbox[0]) / 2.0
-        #test_dimension = bbox[1] - bbox[0] + center
-
-        dimension = bbox[1] - bbox[0]
-
-        # Get the maximum dimension of the bounding box using the diagonal length
-        max_dimension = math.sqrt(dimension[0]**2 + dimension[1]**2)
-
-        #Get vertical camera angle
+        if mode is None:
+            mode = self.framingMode
+
+        framing = self.getFraming(objectArg)
+
+        #Get the smaller of the camera angles
         fov = min(cameraArg.data.angle_y, cameraArg.data.angle_x)
 
         #lens can also be used if you know the equation
@@ -252,17 +716,132 @@ class Generator():
         #https://www.omnicalculator.com/other/camera-field-of-view
         #https://blender.stackexchange.com/questions/92201/what-does-focal-length-mean-in-blender
         #http://www.artdecocameras.com/resources/angle-of-view/
-        distance = max_dimension / (2*math.tan(fov/ 2))
-        
-        return distance
+        return float(Framing.fitDistance(framing, fov, mode))
+
+    def sampleCameraDistances(self, indices, distanceRange):
+        '''
+        Camera distances of the given frames, uniform in distanceRange times the fitted
+        distance, reproducible per frame index like the poses
+        '''
+        low, high = distanceRange
+        u = indexedRandom(self.poseSampler.seed, indices, 1, stream=1)[:,0]
+        return self.cameraDistance * (low + (high - low) * u)
+
+    def measureMask(self, mask, record):
+        '''
+        Converts the pass index image to the compact integer mask and, with maskLabels,
+        adds the mask derived labels of every object to record as mask_labels
+        '''
+        mask = toIntegerMask(mask, maskDtype(len(self.objects)))
+
+        if self.maskLabels:
+            record['mask_labels'] = maskStatistics(mask, len(self.objects), record.get('bbox'))
+
+        return mask
+
+    def saveFrame(self, masks, index, mask, passes, record):
+        '''
+        Worker job of a run, saves the extra passes as float16 .npy files next to the mask
+        and hands the mask to the MaskWriter, returns the records that are safe to commit
+        '''
+        mask = self.measureMask(mask, record)
+
+        for name, data in passes.items():
+            passFile = '{name}{index}.npy'.format(name=name.lower(), index=index)
+            np.save(os.path.join(self.annotationFilePath, passFile), data)
+            record[name.lower() + '_file'] = passFile
+
+        return masks.write(index, mask, record)
+
+    def packSample(self, index, imagePath, mask, record, passes = None):
+        '''
+        Worker job of an export run, encodes the members of one sample for the tar shards
+        and removes the rendered image file
+        '''
+        key = 'sample{index:08d}'.format(index=index)
+        members = {}
+
+        if imagePath and os.path.isfile(imagePath):
+            extension = os.path.splitext(imagePath)[1][1:].lower()
+            with open(imagePath, 'rb') as infile:
+                members[extension] = infile.read()
+            os.unlink(imagePath)
+            record['image_file'] = key + '.' + extension
+
+        buffer = io.BytesIO()
+        np.save(buffer, self.measureMask(mask, record))
+        members['mask.npy'] = buffer.getvalue()
+        record['segmentation_file'] = key + '.mask.npy'
+
+        for name, data in (passes or {}).items():
+            buffer = io.BytesIO()
+            np.save(buffer, data)
+            members[name.lower() + '.npy'] = buffer.getvalue()
+            record[name.lower() + '_file'] = key + '.' + name.lower() + '.npy'
+
+        members['json'] = json.dumps(record).encode('utf-8')
+
+        return [(key, members, record)]
+
+    def generateData(self, amount = 0, format = 'PNG', startIndex = 0, resume = False,
+                     maskFormat = 'npy', maskChunkSize = 256, traceFile = None,
+                     workers = 2, maxPending = None, distanceRange = None, exporter = None,
+                     memoryInterval = 0, memoryFile = None, poseRange = None):
+        '''
+        Renders amount frames and writes the data and annotation,
+        ids and file names start at startIndex so several runs can be merged
+
+        Every record is streamed to annotation.jsonl as soon as its frame is saved,
+        with resume the existing output is kept and the run continues after the
+        last fully written index instead of starting over
+
+        maskFormat selects how the segmentation is stored, see MaskStorage
+        ('npy', 'rle', 'npz' or 'memmap'), masks use the smallest integer dtype
+        that fits the number of objects
+
+        The time of every stage is recorded in self.timer and summarized at the end,
+        traceFile writes the per frame timings as CSV or JSON
+
+        Mask conversion and saving run on a pool of workers threads while the next
+        frame renders, at most maxPending frames are queued, workers = 0 saves
+        every frame before rendering the next one
+
+        distanceRange (low, high) samples the camera distance of every frame as a multiple
+        of the fitted distance, the geometry is only measured once per model
+
+        exporter is an optional TarExporter.ShardWriter, every sample (image, compact mask
+        and json record) is then streamed into tar shards instead of
+        leaving one file per image and mask behind, resume is not supported with it
+
+        With setRandomization the sun, camera roll, world, materials and HDRI backdrop are
+        randomized from parameters sampled for the whole run, the values of every frame
+        are stored under randomization in its record
+
+        poseRange (start, amount) is the range stratified poses are stratified over, the
+        frames of this call by default, parts of a larger run pass the range of the whole run
+
+        memoryInterval samples the resident memory and the blender datablock counts every
+        memoryInterval frames (see Profiling.MemoryMonitor), memoryFile writes the samples as JSON
+
+        With maskLabels every record gets mask_labels, the tight bounding box, pixel area,
+        centroid and bounding box coverage of every object measured on its mask
+
+        Every record has the camera_intrinsics K and the translation of the object axis in the
+        camera frame, keypoints enabled with setKeypoints are projected for every frame
+
+        Extra passes enabled with setSegmentationNodes(passes=...) come from the same render,
+        every record gets depth_file / normal_file pointing at float16 .npy arrays
+        '''
+        if exporter is not None and resume:
+            raise ValueError('Resuming is not supported when exporting to shards')
 
-    def generateData(self, amount = 0, format = 'PNG'):
         #### TODO Set position and different angels for camera randomize them
         #### Freeform and locked
         #### DONE: Locked
 
-        self.cleanFolder(self.dataFilePath)
-        self.cleanFolder(self.annotationFilePath)
+        if not resume:
+            self.cleanFolder(self.dataFilePath)
+            self.cleanFolder(self.annotationFilePath)
 
         self.scene.render.image_settings.file_format= format
 
@@ -273,136 +852,643 @@ class Generator():
         axis = self.CameraAxis
         lighting = self.lighting
         camera = self.Camera
-        
-        fileList = []
 
-        annotationfile = os.path.join(self.annotationFilePath, 'annotation.json')
-        
-        
+        writer = AnnotationWriter(self.annotationFilePath, resume=resume)
 
-        for i in range(amount):
+        firstIndex = startIndex
+        if resume and writer.lastIndex is not None:
+            firstIndex = max(startIndex, writer.lastIndex + 1)
+            print('Resuming data generation from index {index}'.format(index=firstIndex))
 
-            #Get random quaternion for position
-            quaternion = mathutils.Quaternion(self.randomQuaternion())
-            axis.rotation_quaternion = axis.rotation_quaternion @ quaternion
-            lighting.rotation_quaternion = lighting.rotation_quaternion @ quaternion
-            
-            # distance = self.rng.uniform(0, 15*self.cameraDistance)
-            # camera.location = (0,0,distance)
+        res_x, res_y = self.getResolution()
+        masks = None
+        if exporter is None:
+            masks = MaskWriter(self.annotationFilePath, format=maskFormat,
+                               numObjects=len(self.objects), shape=(res_y, res_x),
+                               firstIndex=startIndex, endIndex=startIndex + amount,
+                               chunkSize=maskChunkSize, resume=resume, nextIndex=firstIndex)
+
+        timer = self.timer
+        timer.reset()
+
+        memory = self.memory
+        memory.interval = memoryInterval
+        memory.reset()
+
+        #Records are written in frame order on this thread once their masks are saved
+        def writeRecords(records):
+            for record in records:
+                writer.write(record)
+
+        #Samples are appended to the shards in frame order, then their records are written
+        def exportSamples(samples):
+            for key, members, record in samples:
+                record['shard'] = exporter.write(key, members)
+                writer.write(record)
+
+        #Jobs are timed inside the worker, the 'save' stage only covers handing them over
+        def timedJob(frame, job, *args):
+            start = time.perf_counter()
+            result = job(*args)
+            return frame, time.perf_counter() - start, result
+
+        def consumeJob(output):
+            frame, seconds, result = output
+            timer.addTime(frame, 'save_worker', seconds)
+            if exporter is None:
+                writeRecords(result)
+            else:
+                exportSamples(result)
+
+        pipeline = OrderedPipeline(consumeJob, workers=workers, maxPending=maxPending)
+
+        #Sample every pose of the run at once, poses are independent of each other
+        self.poseSampler.setRange(*(poseRange or (startIndex, amount)))
+        poses = self.poseSampler.batch(firstIndex, startIndex + amount - firstIndex)
+
+        #The randomized parameters of the run are sampled in one batch as well
+        parameters = None
+        randomizer = self.randomizer
+        if randomizer is not None:
+            parameters = randomizer.sample(self.poseSampler.seed, np.arange(firstIndex, startIndex + amount), poses)
+            self.appliedRandomization = {}
+            if distanceRange is None:
+                distanceRange = randomizer.cameraDistance
+
+        distances = None
+        if distanceRange:
+            distances = self.sampleCameraDistances(np.arange(firstIndex, startIndex + amount), distanceRange)
+
+        #Views share the lens of the main camera, the intrinsics are the same for every frame
+        intrinsics = self.getCameraIntrinsics().tolist()
+
+        #One render per batch, every view of the batch renders its own frame
+        rigs = self.viewRigs if self.viewRigs else [(axis, camera, None)]
+        endIndex = startIndex + amount
+
+        #Closing the pipeline waits for the queued frames, a failure stops it right away
+        with pipeline:
+            for batchStart in range(firstIndex, endIndex, len(rigs)):
+                batch = list(range(batchStart, min(batchStart + len(rigs), endIndex)))
+                timer.startFrame(batchStart)
+
+                if any(memory.due(i - firstIndex) for i in batch):
+                    memory.sample(batchStart, self.datablockCounts())
+
+                #Set the pose of every camera axis, the sun is locked to the first camera
+                with timer.stage('pose'):
+                    for k, (rigAxis, rigCamera, suffix) in enumerate(rigs):
+                        if suffix is not None:
+                            #Views without a frame in the last batch are not rendered
+                            self.scene.render.views[self.viewName(k)].use = k < len(batch)
+                        if k >= len(batch):
+                            continue
+
+                        i = batch[k]
+                        quaternion = mathutils.Quaternion(poses[i - firstIndex])
+                        rigAxis.rotation_quaternion = quaternion
+                        if k == 0:
+                            lighting.rotation_quaternion = quaternion
+
+                        #Distance and roll of an earlier run are reset so the record describes the camera
+                        if distances is not None:
+                            rigCamera.location = (0, 0, distances[i - firstIndex])
+                        else:
+                            rigCamera.location = (0, 0, self.cameraDistance)
+
+                        if parameters is not None and 'cameraRoll' in parameters:
+                            rigCamera.rotation_euler = (0, 0, parameters['cameraRoll'][i - firstIndex])
+                        else:
+                            rigCamera.rotation_euler = (0, 0, 0)
+
+                #Sun, world and materials are shared by the views of a batch
+                if parameters is not None:
+                    with timer.stage('randomize'):
+                        self.applyRandomization(parameters, batchStart - firstIndex)
+
+                #Set the render save path for the image, views add their suffix to the name
+                imageFile = 'image{index}'.format(index = batchStart)
+                imagePath = os.path.join(self.dataFilePath, imageFile)
+                self.scene.render.filepath = imagePath
+
+                #render the view and save, with a mask only profile the image is not written
+                with timer.stage('render'):
+                    bpy.ops.render.render(write_still=not self.maskOnly)
+
+                for k, i in enumerate(batch):
+                    rigAxis, rigCamera, suffix = rigs[k]
+
+                    # Bounding box coordinates
+                    with timer.stage('bbox'):
+                        bbox = self.getBoundingBoxCoordinates(rigCamera)
+
+                    # retrieve segmentation
+                    with timer.stage('segmentation'):
+                        segmentation = self.getSegmentation(suffix)
+                        passes = {name : self.getPass(name, suffix) for name in self.extraPasses}
+
+                    #Dictionary for the annotation
+                    data = {'id': i,
+                            'image_file' : None if self.maskOnly else imageFile + (suffix or ''),
+                            'bbox' : bbox,
+                            'quaternion' : list(rigAxis.rotation_quaternion)
+                        }
+
+                    if distances is not None:
+                        data['camera_distance'] = float(distances[i - firstIndex])
+
+                    if parameters is not None:
+                        data['randomization'] = randomizer.record(parameters, batchStart - firstIndex)
+                        if 'cameraRoll' in parameters:
+                            data['randomization']['camera_roll'] = float(parameters['cameraRoll'][i - firstIndex])
+
+                    #Object position in the camera frame, together with the quaternion the full pose
+                    data['camera_intrinsics'] = intrinsics
+                    data['translation'] = self.getTranslation(rigCamera)
+
+                    if self.keypointSource is not None:
+                        with timer.stage('keypoints'):
+                            data['keypoints'] = self.projectKeypoints(segmentation[:,:,0], rigCamera)
+
+                    #Save the compact segmentation in the background, the mask location is added to the record
+                    #The viewer buffer is reused by the next render so the pass is copied first
+                    #Records are appended as soon as their masks are on disk
+                    with timer.stage('save'):
+                        mask = np.ascontiguousarray(segmentation[:,:,0])
+                        if exporter is None:
+                            pipeline.submit(timedJob, batchStart, self.saveFrame, masks, i, mask, passes, data)
+                        else:
+                            #The batch image name is still needed by the next views
+                            renderedFile = data['image_file']
+                            renderedImage = None
+                            if renderedFile:
+                                renderedImage = os.path.join(self.dataFilePath, renderedFile + self.scene.render.file_extension)
+                            pipeline.submit(timedJob, batchStart, self.packSample, i, renderedImage, mask, data, passes)
+
+                timer.endFrame()
+
+        if masks is not None:
+            writeRecords(masks.close())
+
+        #Write the complete annotation.json from the streamed records
+        writer.finalize()
+        writer.close()
+
+        self.releaseImages()
+
+        timer.printSummary()
+        if traceFile:
+            timer.dumpTrace(traceFile)
+
+        if memory.interval > 0:
+            memory.sample(endIndex, self.datablockCounts())
+            memory.printSummary()
+            if memoryFile:
+                memory.dump(memoryFile)
+
+    def replayPose(self, record):
+        '''
+        Puts the camera rig and the sun into the pose of an annotation record,
+        the way generateData left them when the frame was rendered
+        '''
+        quaternion = mathutils.Quaternion(record['quaternion'])
+        self.CameraAxis.rotation_quaternion = quaternion
+        self.lighting.rotation_quaternion = quaternion
 
-            #Set the render save path for the image
-            imageFile = 'image{index}'.format(index = i)
-            imagePath = os.path.join(self.dataFilePath, imageFile)
-            self.scene.render.filepath = imagePath
+        randomization = record.get('randomization', {})
+        if 'sun_quaternion' in randomization:
+            self.lighting.rotation_quaternion = mathutils.Quaternion(randomization['sun_quaternion'])
 
-            #render the view and save
-            bpy.ops.render.render(write_still=True)
+        self.Camera.location = (0, 0, record.get('camera_distance', self.cameraDistance))
+        self.Camera.rotation_euler = (0, 0, randomization.get('camera_roll', 0.0))
 
-            #Set segmentation image file path and name
-            segmentationFile = 'segmentation{index}.npy'.format(index=i)
-            segmentationPath = os.path.join(self.annotationFilePath, segmentationFile)
+    def reannotate(self, labels = None, workers = None, chunkSize = 1024, shardPath = None,
+                   maskFormat = None, maskChunkSize = 256):
+        '''
+        Recomputes the labels of the existing annotation.json from the stored poses,
+        nothing is rendered
 
-            # Bounding box coordinates
-            # bbox = self.getBoundingBoxCoordinates()
+        labels is a list of Reannotation.LABELS ('bbox', 'keypoints', 'translation',
+        'mask_labels'), by default all of them, keypoints only when setKeypoints is used.
+        The camera matrices of all records are rebuilt with numpy from the quaternion,
+        camera distance and roll, and the records are relabeled in chunks of chunkSize
+        on workers processes (0 runs in this process). The same model has to be loaded
+        at the resolution the data was rendered at.
 
-            # retrieve segmentation
-            segmentation = self.getSegmentation()
+        shardPath is needed to read the masks of samples exported to tar shards,
+        maskFormat converts the stored masks to another format of MaskStorage
 
-            #Save segmentation array to npy file
-            np.save(segmentationPath, segmentation[:,:,0])
+        annotation.json (and annotation.jsonl) are replaced atomically with the updated records
+        '''
+        if labels is None:
+            labels = [label for label in Reannotation.LABELS if label != 'keypoints' or self.keypointSource is not None]
+
+        for label in labels:
+            if label not in Reannotation.LABELS:
+                raise ValueError('Unknown label: ' + str(label))
+
+        if 'keypoints' in labels and self.keypointSource is None:
+            raise ValueError('Keypoints need setKeypoints before reannotating')
+
+        with open(os.path.join(self.annotationFilePath, 'annotation.json')) as infile:
+            records = json.load(infile)['images']
+
+        if not records:
+            print('No records to reannotate')
+            return records
+
+        quaternions = np.array([record['quaternion'] for record in records], dtype=np.float64)
+        distances = np.array([record.get('camera_distance', self.cameraDistance) for record in records], dtype=np.float64)
+        rolls = np.array([record.get('randomization', {}).get('camera_roll', 0.0) for record in records], dtype=np.float64)
+
+        objectAxisMatrix = Projection.matrixToArray(self.ObjectAxis.matrix_world)
+        projection = self.getProjectionMatrix()
+
+        #Replay the first pose on the rig to check the rebuilt matrices match blender
+        self.replayPose(records[0])
+        rebuilt = projection @ Reannotation.viewMatrices(quaternions[:1], distances[:1], rolls[:1], objectAxisMatrix)[0]
+        if not np.allclose(rebuilt, self.getCameraMatrix(), atol=1e-6):
+            raise RuntimeError('Rebuilt camera matrices do not match the camera rig')
+
+        vertices = None
+        if 'bbox' in labels:
+            vertices = self.vertexCache if self.vertexCache is not None else self.cacheVertices()
+
+        keypoints = self.getKeypoints() if 'keypoints' in labels else None
+
+        jobs = []
+        for start in range(0, len(records), chunkSize):
+            rows = list(range(start, min(start + chunkSize, len(records))))
+            jobs.append({'rows' : rows,
+                         'records' : records[start:rows[-1] + 1],
+                         'labels' : list(labels),
+                         'quaternions' : quaternions[rows],
+                         'distances' : distances[rows],
+                         'rolls' : rolls[rows],
+                         'objectAxisMatrix' : objectAxisMatrix,
+                         'projection' : projection,
+                         'resolution' : self.getResolution(),
+                         'vertices' : vertices,
+                         'keypoints' : keypoints,
+                         'keypointRadius' : self.keypointRadius,
+                         'numObjects' : len(self.objects),
+                         'annotationPath' : self.annotationFilePath,
+                         'shardPath' : shardPath})
+
+        for results in Reannotation.runChunks(jobs, workers):
+            for row, fields in results:
+                records[row].update(fields)
+
+        intrinsics = self.getCameraIntrinsics().tolist()
+        for record in records:
+            record['camera_intrinsics'] = intrinsics
+
+        if maskFormat is not None:
+            self.convertMasks(records, maskFormat, maskChunkSize)
+
+        Reannotation.writeAnnotation(self.annotationFilePath, records)
+        print('Reannotated {count} records: {labels}'.format(count=len(records), labels=', '.join(labels)))
+
+        return records
+
+    def convertMasks(self, records, maskFormat, maskChunkSize = 256):
+        '''
+        Rewrites the masks of records in another MaskStorage format and removes the
+        mask files that are not used anymore
+        '''
+        if any('shard' in record for record in records):
+            raise ValueError('Masks stored in shards cannot be converted')
 
-            #Dictionary for the annotation
-            data = {'id': i,
-                    'image_file' : imageFile,
-                    'segmentation_file' : segmentationFile,
-                    # 'bbox' : bbox,
-                    'quaternion' : list(axis.rotation_quaternion)
-                }
-            
+        if all(maskFormatOf(record) == maskFormat for record in records):
+            print('Masks are already stored as ' + maskFormat)
+            return records
 
-            # Append a dictionary to list
-            fileList.append(data)
+        oldFiles = {record.get('segmentation_file') for record in records} - {None}
 
-        #Dump the list into a json file
-        annotation = { 'images' : fileList}
-        with open(annotationfile, 'w+') as outfile:
-            json.dump(annotation, outfile, indent=4)
+        ids = [record['id'] for record in records]
+        res_x, res_y = self.getResolution()
+        reader = MaskReader(self.annotationFilePath)
+        writer = MaskWriter(self.annotationFilePath, format=maskFormat,
+                            numObjects=len(self.objects), shape=(res_y, res_x),
+                            firstIndex=min(ids), endIndex=max(ids) + 1, chunkSize=maskChunkSize)
 
-    def getBoundingBox(self, object):
-        '''
-        Returns camera bounding box of mesh object.
+        for record in records:
+            #Copied out of the memory map before the record forgets where it came from
+            mask = np.array(reader.read(record))
+            for key in ('segmentation_file', 'segmentation_key', 'segmentation_index', 'segmentation_rle',
+                        'segmentation_size'):
+                record.pop(key, None)
+            writer.write(record['id'], mask, record)
 
-        Negative 'z' value means the point is behind the camera.
+        writer.close()
+        reader.close()
 
-        https://federicoarenasl.github.io/Data-Generation-with-Blender/#Main-function-to-extract-labels-from-all-objects-in-image
-        https://blender.stackexchange.com/questions/7198/save-the-2d-bounding-box-of-an-object-in-rendered-image-to-a-text-file
+        newFiles = {record.get('segmentation_file') for record in records}
+        for segmentationFile in oldFiles - newFiles:
+            os.unlink(os.path.join(self.annotationFilePath, segmentationFile))
+
+        return records
+
+    def viewName(self, index):
+        '''Name of the render view of camera rig index'''
+        return 'View{index}'.format(index=index)
+
+    def setViews(self, count = 1):
+        '''
+        Renders count camera poses in one render by placing count camera rigs under the
+        object axis and rendering them as the views of a multi view render, the scene
+        sync and BVH build are paid once per batch instead of once per frame
 
+        Views are read back from individual EXR files so the segmentation is switched to 'exr',
+        the sun follows the first camera of every batch
         '''
+        render = self.scene.render
+
+        #Remove the rigs of a previous call
+        for rigAxis, rigCamera, suffix in self.viewRigs:
+            bpy.data.objects.remove(rigCamera, do_unlink = True)
+            bpy.data.objects.remove(rigAxis, do_unlink = True)
+            view = render.views.get(self.viewName(int(suffix[1:])))
+            if view is not None:
+                render.views.remove(view)
+        self.viewRigs = []
+
+        if count <= 1:
+            render.use_multiview = False
+            return
+
+        render.use_multiview = True
+        render.views_format = 'MULTIVIEW'
+        render.image_settings.views_format = 'INDIVIDUAL'
+
+        #Stereo views are not used
+        for view in render.views:
+            view.use = False
 
-        #Transformation matrix
-        matrix = self.Camera.matrix_world.normalized().inverted()
+        for k in range(count):
+            #The view camera is the scene camera name with the view suffix
+            suffix = '_{index}'.format(index=k)
 
-        #Using inverse of matrix to undo any transformation
-        mesh = object.to_mesh(preserve_all_data_layers=True)
-        # mesh = object
-        mesh.transform(object.matrix_world)
-        mesh.transform(matrix)
+            rigAxis = bpy.data.objects.new(name='CameraAxis' + suffix, object_data=None)
+            self.scene.collection.objects.link(rigAxis)
+            rigAxis.parent = self.ObjectAxis
+            rigAxis.rotation_mode = 'QUATERNION'
+            rigAxis.rotation_quaternion = (1,0,0,0)
 
-        #world coordinates for the camera view frame bounding box
-        frame = [-v for v in self.Camera.data.view_frame(scene=self.scene)[:3]]
+            #Views share the lens of the main camera
+            rigCamera = bpy.data.objects.new(self.scene.camera.name + suffix, self.Camera.data)
+            self.scene.collection.objects.link(rigCamera)
+            rigCamera.parent = rigAxis
+            rigCamera.location = (0, 0, self.cameraDistance)
 
-        # Check if camera is in perspective or orthographic mode, 
-        # camera_persp = self.camera.type != 'ORTHO'
+            view = render.views.new(self.viewName(k))
+            view.camera_suffix = suffix
+            view.use = True
 
-        lx = []
-        ly = []
+            self.viewRigs.append((rigAxis, rigCamera, suffix))
 
-        for v in mesh.vertices:
-            co_local = v.co
-            z = -co_local.z
+        if self.segmentationMode != 'exr':
+            print('Multi view rendering reads the segmentation from EXR files')
+            self.segmentationMode = 'exr'
+            if self.scene.use_nodes:
+                self.setSegmentationNodes()
 
-            if z <= 0.0:
-                # Vertex is behind the camera; ignore it.
+    def cacheVertices(self):
+        '''
+        Reads the vertices of every object once with foreach_get and stores them in world space
+
+        The objects never move relative to the world, only the camera rig rotates around them,
+        so the cache is valid for every frame until another object is imported
+        '''
+        depsgraph = bpy.context.evaluated_depsgraph_get()
+
+        points = []
+        offsets = []
+        count = 0
+
+        for object in self.objects:
+            offsets.append(count)
+
+            if object.type != 'MESH':
                 continue
-            else:
-                # Perspective division #
-                frame = [(v / (v.z / z)) for v in frame]
 
-            min_x, max_x = frame[1].x, frame[2].x
-            min_y, max_y = frame[0].y, frame[1].y
+            #Evaluated mesh includes modifiers, cleared right after reading the coordinates
+            evaluated = object.evaluated_get(depsgraph)
+            mesh = evaluated.to_mesh()
 
-            x = (co_local.x - min_x) / (max_x - min_x)
-            y = (co_local.y - min_y) / (max_y - min_y)
+            try:
+                coordinates = np.empty(len(mesh.vertices) * 3, dtype=np.float64)
+                mesh.vertices.foreach_get('co', coordinates)
+                coordinates = coordinates.reshape((-1, 3))
+            finally:
+                evaluated.to_mesh_clear()
 
-            lx.append(x)
-            ly.append(y)
+            matrix = Projection.matrixToArray(object.matrix_world)
+            points.append(Projection.transformPoints(coordinates, matrix))
+            count += len(coordinates)
 
-        #Image is not in view if all the mesh verts were ignored
-        if not lx or not ly:
-            return None
+        points = np.concatenate(points) if points else np.empty((0, 3))
 
-        #Limit the values between 0.0 and 1.0
-        min_x = np.clip(min(lx), 0.0, 1.0)
-        min_y = np.clip(min(ly), 0.0, 1.0)
+        self.vertexCache = {'points' : points,
+                            'offsets' : np.array(offsets, dtype=np.int64)}
 
-        max_x = np.clip(max(lx), 0.0, 1.0)
-        max_y = np.clip(max(ly), 0.0, 1.0)
+        return self.vertexCache
 
-        #Image is not in view if both bounding points exist on the same side
-        if min_x == max_x or min_y == max_y:
-            return None
+    def getCameraMatrix(self, camera = None):
+        '''
+        Returns the 4x4 numpy projection @ view matrix of the camera for the current render resolution
+        '''
+        if camera is None:
+            camera = self.Camera
+
+        #Make sure matrix_world reflects the latest rig rotation
+        bpy.context.view_layer.update()
+
+        depsgraph = bpy.context.evaluated_depsgraph_get()
+        res_x, res_y = self.getResolution()
+        render = self.scene.render
+
+        projection = camera.calc_matrix_camera(depsgraph,
+                                               x=res_x, y=res_y,
+                                               scale_x=render.pixel_aspect_x,
+                                               scale_y=render.pixel_aspect_y)
 
-        #Get resolution for the render to create the coco annotation
+        view = camera.matrix_world.normalized().inverted()
+
+        return Projection.matrixToArray(projection @ view)
+
+    def getProjectionMatrix(self, camera = None):
+        '''
+        Returns the 4x4 numpy projection matrix of the camera for the current render resolution
+        '''
+        if camera is None:
+            camera = self.Camera
+
+        depsgraph = bpy.context.evaluated_depsgraph_get()
+        res_x, res_y = self.getResolution()
         render = self.scene.render
-        # fac = render.resolution_percentage * 0.01
-        dim_x = render.resolution_x
-        dim_y = render.resolution_y 
 
+        return Projection.matrixToArray(camera.calc_matrix_camera(depsgraph,
+                                                                  x=res_x, y=res_y,
+                                                                  scale_x=render.pixel_aspect_x,
+                                                                  scale_y=render.pixel_aspect_y))
+
+    def getCameraIntrinsics(self, camera = None):
+        '''
+        Returns the 3x3 pinhole camera matrix K in pixels, for camera coordinates with
+        x right, y down and z forward and pixel 0,0 at the top left of the image
+        '''
+        projection = self.getProjectionMatrix(camera)
+        res_x, res_y = self.getResolution()
+
+        return Projection.intrinsicsFromProjection(projection, (res_x, res_y))
+
+    def projectBoundingBoxes(self, camera = None):
+        '''
+        Projects the cached vertices of all objects in one pass and returns a (K,4) array
+        of COCO style boxes, NaN rows for objects that are not in view
+        '''
+        if self.vertexCache is None:
+            self.cacheVertices()
+
+        resolution = self.getResolution()
+        matrix = self.getCameraMatrix(camera)
+
+        pixels, depth = Projection.projectPoints(self.vertexCache['points'], matrix, resolution)
+
+        return Projection.boundingBoxes(pixels, depth, self.vertexCache['offsets'], resolution)
 
-        #Return coordinates in coco style annotation
-        return (min_x*dim_x, (1-min_y)*dim_y), (max_x*dim_x, (1-max_y)*dim_y)
+    def setKeypoints(self, source = 'bbox', count = 8, landmarks = None, radius = 2):
+        '''
+        Enables 2D keypoint labels, the 3D keypoints of every object come from:
+        'bbox'      : the 8 corners of the object bound_box
+        'landmarks' : landmarks, a dictionary of object name -> list of local coordinates
+        'fps'       : count vertices picked by farthest point sampling
+
+        radius is the window in pixels used to find a keypoint's object in the mask,
+        source None disables the keypoints
+        '''
+        if source is not None and source not in Keypoints.SOURCES:
+            raise ValueError('Unknown keypoint source: ' + str(source))
+
+        self.keypointSource = source
+        self.keypointCount = count
+        self.landmarks = landmarks or {}
+        self.keypointRadius = radius
+
+        #Keypoints of another source are not valid anymore
+        self.keypointCache = {}
+
+    def getKeypoints(self):
+        '''
+        World space 3D keypoints of all objects stacked in one (N,3) array with the start
+        offset and the pass index of every keypoint, computed once per model
+        '''
+        key = tuple(obj.name for obj in self.objects)
+        if key in self.keypointCache:
+            return self.keypointCache[key]
+
+        if self.keypointSource == 'fps' and self.vertexCache is None:
+            self.cacheVertices()
+
+        points = []
+        offsets = []
+        count = 0
+
+        for i, object in enumerate(self.objects):
+            offsets.append(count)
+            matrix = Projection.matrixToArray(object.matrix_world)
+
+            if self.keypointSource == 'bbox':
+                objectPoints = Projection.transformPoints(np.array(object.bound_box, dtype=np.float64), matrix)
+
+            elif self.keypointSource == 'landmarks':
+                local = np.array(self.landmarks.get(object.name, []), dtype=np.float64).reshape((-1, 3))
+                objectPoints = Projection.transformPoints(local, matrix)
+
+            else:
+                #The vertex cache is already in world space
+                offsetsCache = self.vertexCache['offsets']
+                end = offsetsCache[i+1] if i+1 < len(offsetsCache) else len(self.vertexCache['points'])
+                vertices = self.vertexCache['points'][offsetsCache[i]:end]
+                objectPoints = vertices[Keypoints.farthestPointSampling(vertices, self.keypointCount)]
+
+            points.append(objectPoints)
+            count += len(objectPoints)
+
+        points = np.concatenate(points) if points else np.empty((0, 3))
+        offsets = np.array(offsets, dtype=np.int64)
+
+        #Pass index of the object every keypoint belongs to
+        sizes = np.diff(np.append(offsets, count))
+        labels = np.repeat(np.arange(1, len(offsets) + 1), sizes)
+
+        self.keypointCache[key] = {'points' : points, 'offsets' : offsets, 'labels' : labels}
+
+        return self.keypointCache[key]
+
+    def projectKeypoints(self, segmentation, camera = None):
+        '''
+        Projects the cached keypoints of all objects with one matmul and returns their
+        COCO keypoint annotations keyed by pass index, visibility is checked against
+        the segmentation of the same camera
+        '''
+        keypoints = self.getKeypoints()
+
+        resolution = self.getResolution()
+        matrix = self.getCameraMatrix(camera)
+
+        pixels, depth = Projection.projectPoints(keypoints['points'], matrix, resolution)
+        visibility = Keypoints.keypointVisibility(pixels, depth, keypoints['labels'],
+                                                  segmentation, self.keypointRadius)
+
+        return Keypoints.cocoKeypoints(pixels, visibility, keypoints['offsets'])
+
+    def getTranslation(self, camera = None):
+        '''
+        Position of the object axis in the camera frame (x right, y down, z forward),
+        the frame of the camera intrinsics
+        '''
+        if camera is None:
+            camera = self.Camera
+
+        view = Projection.matrixToArray(camera.matrix_world.normalized().inverted())
+        return Keypoints.cameraTranslation(view, self.ObjectAxis.matrix_world.translation)
+
+    def getBoundingBox(self, object):
+        '''
+        Returns camera bounding box of mesh object.
+
+        Uses the cached vertices, vertices behind the camera are ignored.
+
+        https://federicoarenasl.github.io/Data-Generation-with-Blender/#Main-function-to-extract-labels-from-all-objects-in-image
+        https://blender.stackexchange.com/questions/7198/save-the-2d-bounding-box-of-an-object-in-rendered-image-to-a-text-file
+
+        '''
+        if self.vertexCache is None:
+            self.cacheVertices()
+
+        index = self.objects.index(object)
+        offsets = self.vertexCache['offsets']
+        start = offsets[index]
+        end = offsets[index+1] if index+1 < len(offsets) else len(self.vertexCache['points'])
+
+        resolution = self.getResolution()
+        matrix = self.getCameraMatrix()
+
+        pixels, depth = Projection.projectPoints(self.vertexCache['points'][start:end], matrix, resolution)
+        box = Projection.boundingBoxes(pixels, depth, [0], resolution)[0]
+
+        #Image is not in view
+        if np.isnan(box[0]):
+            return None
+
+        x, y, width, height = box.tolist()
+
+        #Return corner coordinates, formatCoordinates turns them into coco style annotation
+        return (x, y + height), (x + width, y)
     
-    def setSegmentationNodes(self):
+    def setSegmentationNodes(self, passes = None):
         '''This section uses the compositor functions in blender and sets it up
             Some terminologies:
             Nodes -> Collection of nodes in the compositor and contains inputs and outputs,
@@ -411,14 +1497,29 @@ class Generator():
             Links -> Links handles the links between the nodes, this is used for 
                     linking inputs and outputs of nodes together
 
-            Using Temporary file, for now in Open EXR format
+            In 'memory' mode the IndexOB pass goes to a viewer node and is read from the
+            'Viewer Node' image after every render.
+
+            In 'exr' mode a temporary file is used, for now in Open EXR format
             https://blender.stackexchange.com/questions/148231/what-image-format-encodes-the-fastest-or-at-least-faster-png-is-too-slow
+
+            passes lists extra ground truth passes from RENDER_PASSES ('Depth', 'Normal'),
+            they are written by the same render to one EXR file per pass
         '''
+        if passes is not None:
+            for name in passes:
+                if name not in RENDER_PASSES:
+                    raise ValueError('Unknown render pass: ' + str(name))
+            self.extraPasses = list(passes)
 
         #Set engine to cycles for object indexing
         self.scene.render.engine = 'CYCLES'
         # bpy.context.scene.render.engine = 'CYCLES'
-        self.scene.view_layers['ViewLayer'].use_pass_object_index = True
+        viewLayer = self.scene.view_layers['ViewLayer']
+        viewLayer.use_pass_object_index = True
+
+        for name in self.extraPasses:
+            setattr(viewLayer, RENDER_PASSES[name][0], True)
 
         self.scene.use_nodes = True
 
@@ -428,15 +1529,39 @@ class Generator():
         nodes = self.scene.node_tree.nodes
         links = self.scene.node_tree.links
 
-        #Remove initial composite node
-        nodes.remove(nodes['Composite'])
-
         #layer node
         renderLayers = nodes['Render Layers']
 
-        # segmentationViewer = nodes.new(type='CompositorNodeViewer')
-        # segmentationViewer.name = 'Segmentation'
-        # segmentationViewer.label = 'Segmentation'
+        #Blender only renders with a composite or file output node, memory mode has no file output
+        #so the composite node is kept there, otherwise the initial composite node is removed
+        if self.segmentationMode == 'memory':
+            composite = nodes.get('Composite') or nodes.new(type='CompositorNodeComposite')
+            composite.name = 'Composite'
+            links.new(renderLayers.outputs['Image'], composite.inputs['Image'])
+        elif 'Composite' in nodes:
+            nodes.remove(nodes['Composite'])
+
+        #Nodes of a previous call or of a cached scene are rebuilt
+        for name in ('Segmentation', 'OutputFile'):
+            if name in nodes:
+                nodes.remove(nodes[name])
+
+        if self.segmentationMode == 'memory':
+            #Viewer node keeps the pass in memory, the image is updated after each render
+            segmentationViewer = nodes.new(type='CompositorNodeViewer')
+            segmentationViewer.name = 'Segmentation'
+            segmentationViewer.label = 'Segmentation'
+            segmentationViewer.use_alpha = False
+
+            links.new(renderLayers.outputs['IndexOB'], segmentationViewer.inputs[0])
+
+        #Passes written to file, the viewer only holds one image
+        slots = [] if self.segmentationMode == 'memory' else [('SegmentationMask', 'IndexOB')]
+        slots += [(name, RENDER_PASSES[name][1]) for name in self.extraPasses]
+
+        if not slots:
+            self.updateSceneCache()
+            return
 
         #Create output file node
         outputFile = nodes.new(type='CompositorNodeOutputFile')
@@ -448,6 +1573,8 @@ class Generator():
         outputFile.format.color_mode = 'RGBA'
         outputFile.format.color_depth = '32'
         outputFile.format.exr_codec = 'PIZ'
+        #Multi view renders write one file per view
+        outputFile.format.views_format = 'INDIVIDUAL'
 
         # #Create segmentation node, segmentation uses object pass index
         # segmentation = nodes.new(type='CompositorNodeComposite')
@@ -458,20 +1585,27 @@ class Generator():
 
         #Set the path for the output
         outputFile.base_path = self.tempFilePath
-        segmentationOutput = outputFile.layer_slots.new('SegmentationMask')
+        #Link the index segmentation and the passes to the slots of the output node
+        for slotName, output in slots:
+            slot = outputFile.layer_slots.new(slotName)
+            links.new(renderLayers.outputs[output], slot)
 
-        #Link the index segmentation to the slot of the output node
-        links.new(renderLayers.outputs['IndexOB'], segmentationOutput)
+        self.updateSceneCache()
         
-        # links.new(renderLayers.outputs['IndexOB'], segmentationViewer.inputs[0])
-
         # #Link the layer output to the input of the segmentation node
         # links.new(layers.outputs['IndexOB'], segmentation.inputs[0])
 
-    def getSegmentation(self):
+    def getSegmentation(self, suffix = None):
         '''
-            Loads image exr and returns the data
+            Returns the segmentation of the last render, either from the viewer image
+            or by loading the temporary exr, suffix selects the view of a multi view render
         '''
+        if self.segmentationMode == 'memory':
+            viewer = bpy.data.images.get('Viewer Node')
+            if viewer is None:
+                raise RuntimeError("No 'Viewer Node' image after rendering, call setSegmentationNodes before generating data")
+            return self.readViewer(viewer)
+
         #https://blender.stackexchange.com/questions/170381/how-can-i-get-pixels-from-multiple-render-passes-through-python-and-store-them-t
         #https://blender.stackexchange.com/questions/149444/is-there-some-way-i-can-update-the-viewer-node-during-background-rendering-to-ou
         #https://blender.stackexchange.com/questions/69230/python-render-script-different-outcome-when-run-in-background
@@ -480,10 +1614,37 @@ class Generator():
         filePath = os.path.join(self.tempFilePath, 'SegmentationMask0001.exr')
         # print(filePath)
 
+        if suffix is not None:
+            #Individual views are written with the view suffix before the extension
+            filePath = os.path.join(self.tempFilePath, 'SegmentationMask0001{suffix}.exr'.format(suffix=suffix))
+            if not os.path.isfile(filePath):
+                matches = glob.glob(os.path.join(self.tempFilePath, 'SegmentationMask*{suffix}*.exr'.format(suffix=suffix)))
+                if matches:
+                    filePath = matches[0]
+
         segmentation = self.loadData(filePath)
+        if segmentation is None:
+            raise RuntimeError('Segmentation file was not written: ' + filePath)
 
         return segmentation
 
+    def getPass(self, name, suffix = None):
+        '''
+        Returns an extra pass of the last render as a compact float16 array,
+        (y, x) for depth and (y, x, 3) for normals
+        '''
+        filePath = os.path.join(self.tempFilePath, '{name}0001{suffix}.exr'.format(name=name, suffix=suffix or ''))
+
+        pixels = self.loadData(filePath)
+        if pixels is None:
+            return None
+
+        channels = RENDER_PASSES[name][2]
+        data = pixels[:,:,0] if channels == 1 else pixels[:,:,:channels]
+
+        #Background depth is far beyond float16 and becomes inf
+        return data.astype(np.float16)
+
     def formatCoordinates(self, coordinates):
         '''Formats coordinates into coco style coordinates'''
         if coordinates: 
@@ -506,25 +1667,18 @@ class Generator():
         else:
             pass
     
-    def getBoundingBoxCoordinates(self):
-        allBbox = []
-
-        for i,object in enumerate(self.objects):
-            # print("     On object:", object)
-
-            bbox = self.getBoundingBox(object) # Get current object's coordinates
+    def getBoundingBoxCoordinates(self, camera = None):
+        '''
+        Bounding boxes of all objects in the camera's current view, keyed by the object
+        pass index used in the segmentation
+        '''
+        allBbox = {}
 
-            if bbox: # boundingbox2d are found then do format
-                # print("         Initial coordinates:", bbox)
-                coordinates = self.formatCoordinates(bbox)
-                # print("         coordinates:", coordinates)
+        boxes = self.projectBoundingBoxes(camera)
 
-                # allBbox.append(coordinates) # Update main_text_coordinates variables whith each
-                allBbox[id] = coordinates
-                # line corresponding to each class in the frame of the current image
-            
-            else:
-                print("         Object not visible")
-                pass
+        for i,box in enumerate(boxes):
+            # boundingbox2d are found then store it
+            if not np.isnan(box[0]):
+                allBbox[i+1] = box.tolist()
 
-        return allBbox 
\ No newline at end of file
+        return allBbox
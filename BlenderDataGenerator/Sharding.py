@@ -0,0 +1,136 @@
+'''
+Sharded data generation, splits the frames over several worker processes.
+
+Every worker has its own blender scene, its own Generator and its own shard
+directory (including tmp_exr), the shards are merged into one dataset at the end.
+'''
+import json
+import multiprocessing
+import os
+import shutil
+
+import numpy as np
+
+def splitRange(amount, shards):
+    '''Splits range(amount) into shards contiguous (start, count) pairs'''
+    base, remainder = divmod(amount, shards)
+    ranges = []
+    start = 0
+    for shard in range(shards):
+        count = base + (1 if shard < remainder else 0)
+        ranges.append((start, count))
+        start += count
+    return ranges
+
+def generateShard(job):
+    '''
+    Worker entry point, renders one shard in a fresh blender scene
+
+    bpy is imported here so the module can be loaded without blender in the parent
+    '''
+    from . import SatteliteData
+
+    generator = SatteliteData.Generator(filePath=job['filePath'],
+                                        objectFilePath=job['objectFilePath'],
+                                        segmentationMode=job['segmentationMode'],
+                                        seed=job['seed'])
+
+    if job['setup'] is not None:
+        job['setup'](generator)
+
+    generator.setSegmentationNodes()
+    #Stratified poses are stratified over the frames of all the shards
+    generator.generateData(job['count'], format=job['format'], startIndex=job['start'],
+                           poseRange=job['poseRange'], **job['options'])
+
+    return job['filePath']
+
+def mergeShards(filePath, shardPaths, removeShards = True):
+    '''
+    Moves the data and annotation of every shard into filePath and writes one annotation.json
+
+    File names already carry the global index so they do not collide
+    '''
+    dataFilePath = os.path.join(filePath, 'data/')
+    annotationFilePath = os.path.join(filePath, 'annotation/')
+    os.makedirs(dataFilePath, exist_ok=True)
+    os.makedirs(annotationFilePath, exist_ok=True)
+
+    images = []
+
+    for shardPath in shardPaths:
+        shardData = os.path.join(shardPath, 'data/')
+        shardAnnotation = os.path.join(shardPath, 'annotation/')
+
+        with open(os.path.join(shardAnnotation, 'annotation.json')) as infile:
+            images.extend(json.load(infile)['images'])
+
+        for filename in os.listdir(shardData):
+            shutil.move(os.path.join(shardData, filename), os.path.join(dataFilePath, filename))
+
+        for filename in os.listdir(shardAnnotation):
+            if filename in ('annotation.json', 'annotation.jsonl'):
+                continue
+            shutil.move(os.path.join(shardAnnotation, filename), os.path.join(annotationFilePath, filename))
+
+        if removeShards:
+            shutil.rmtree(shardPath)
+
+    images.sort(key=lambda record: record['id'])
+
+    ids = [record['id'] for record in images]
+    if len(set(ids)) != len(ids):
+        raise ValueError('Duplicate ids found while merging shards')
+
+    annotationfile = os.path.join(annotationFilePath, 'annotation.json')
+    with open(annotationfile, 'w+') as outfile:
+        json.dump({'images' : images}, outfile, indent=4)
+
+    return annotationfile
+
+def runSharded(objectFilePath, amount, workers = None, filePath = None, seed = None,
+               format = 'PNG', segmentationMode = 'memory', setup = None, **options):
+    '''
+    Generates amount frames with workers processes and merges them into filePath
+
+    Each shard gets a disjoint index range, poses only depend on the seed and the
+    frame index so the same seed reproduces the same dataset for any worker count.
+    setup is an optional picklable function called with every worker's Generator
+    before rendering, e.g. to change the resolution,
+    any other keyword is passed on to generateData (e.g. maskFormat)
+    '''
+    if amount == 0:
+        print("No data generated, data size specified is 0\n")
+        return None
+
+    if not filePath:
+        filePath = './'
+
+    #Every shard has to sample from the same pose sequence
+    if seed is None:
+        seed = int(np.random.SeedSequence().entropy)
+
+    if workers is None:
+        workers = os.cpu_count() or 1
+
+    workers = max(1, min(workers, amount))
+
+    jobs = []
+    for shard, (start, count) in enumerate(splitRange(amount, workers)):
+        jobs.append({'filePath' : os.path.join(filePath, 'shard{index}'.format(index=shard)),
+                     'objectFilePath' : objectFilePath,
+                     'segmentationMode' : segmentationMode,
+                     'seed' : seed,
+                     'setup' : setup,
+                     'format' : format,
+                     'start' : start,
+                     'count' : count,
+                     'poseRange' : (0, amount),
+                     'options' : options})
+
+    #Spawn so every worker imports its own copy of bpy instead of a forked scene
+    context = multiprocessing.get_context('spawn')
+    with context.Pool(processes=workers) as pool:
+        shardPaths = pool.map(generateShard, jobs)
+
+    return mergeShards(filePath, shardPaths)
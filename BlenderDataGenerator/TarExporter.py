@@ -0,0 +1,139 @@
+'''
+Training format export, samples are streamed into fixed size tar shards in the
+WebDataset layout (every file of a sample shares its key, e.g. sample00000012.png,
+sample00000012.mask.npy and sample00000012.json).
+
+Every shard gets an index file with the byte offset and size of each member and
+index.json lists the shards and their keys, so reading shard N or a single sample
+never scans the shards before it.
+'''
+import io
+import json
+import os
+import tarfile
+import time
+
+import numpy as np
+
+class ShardWriter():
+    def __init__(self, outputPath, samplesPerShard = 1000, prefix = 'shard'):
+        '''Writes samples into outputPath/{prefix}-{n:05d}.tar, samplesPerShard samples each'''
+        os.makedirs(outputPath, exist_ok=True)
+
+        self.outputPath = outputPath
+        self.samplesPerShard = samplesPerShard
+        self.prefix = prefix
+
+        self.shards = []
+        self.tar = None
+        self.shardName = None
+        self.shardIndex = {}
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def openShard(self):
+        self.shardName = '{prefix}-{index:05d}.tar'.format(prefix=self.prefix, index=len(self.shards))
+        self.tar = tarfile.open(os.path.join(self.outputPath, self.shardName), 'w')
+        self.shardIndex = {}
+
+    def closeShard(self):
+        '''Finishes the current tar, writes its index and updates index.json'''
+        if self.tar is None:
+            return
+
+        self.tar.close()
+        self.tar = None
+
+        indexName = self.shardName[:-len('.tar')] + '.idx.json'
+        with open(os.path.join(self.outputPath, indexName), 'w+') as outfile:
+            json.dump(self.shardIndex, outfile)
+
+        self.shards.append({'shard' : self.shardName,
+                            'index' : indexName,
+                            'keys' : list(self.shardIndex)})
+
+        #Replaced atomically so the index is always complete
+        temporaryfile = os.path.join(self.outputPath, 'index.json.tmp')
+        with open(temporaryfile, 'w+') as outfile:
+            json.dump({'shards' : self.shards}, outfile, indent=4)
+        os.replace(temporaryfile, os.path.join(self.outputPath, 'index.json'))
+
+    def write(self, key, members):
+        '''
+        Adds one sample, members maps an extension (e.g. 'png', 'mask.npy', 'json')
+        to its bytes, returns the name of the shard the sample went into
+        '''
+        if self.tar is None:
+            self.openShard()
+
+        offsets = {}
+        for extension, data in members.items():
+            info = tarfile.TarInfo('{key}.{extension}'.format(key=key, extension=extension))
+            info.size = len(data)
+            info.mtime = time.time()
+
+            #The content starts right after the header blocks of the member
+            header = info.tobuf(self.tar.format, self.tar.encoding, self.tar.errors)
+            offsets[extension] = [self.tar.offset + len(header), len(data)]
+
+            self.tar.addfile(info, io.BytesIO(data))
+
+        #Members are not needed in memory once their offsets are known
+        self.tar.members = []
+
+        self.shardIndex[key] = offsets
+        shardName = self.shardName
+
+        if len(self.shardIndex) >= self.samplesPerShard:
+            self.closeShard()
+
+        return shardName
+
+    def close(self):
+        self.closeShard()
+
+class ShardReader():
+    def __init__(self, outputPath):
+        '''Random access to the shards written by ShardWriter'''
+        self.outputPath = outputPath
+        with open(os.path.join(outputPath, 'index.json')) as infile:
+            self.shards = json.load(infile)['shards']
+        self.indices = {}
+
+    def __len__(self):
+        return len(self.shards)
+
+    def shardIndex(self, shard):
+        '''Member offsets of shard number shard, only its own index file is read'''
+        if shard not in self.indices:
+            with open(os.path.join(self.outputPath, self.shards[shard]['index'])) as infile:
+                self.indices[shard] = json.load(infile)
+        return self.indices[shard]
+
+    def readSample(self, shard, key):
+        '''Returns a dictionary of extension -> bytes of one sample'''
+        members = {}
+        with open(os.path.join(self.outputPath, self.shards[shard]['shard']), 'rb') as infile:
+            for extension, (offset, size) in self.shardIndex(shard)[key].items():
+                infile.seek(offset)
+                members[extension] = infile.read(size)
+        return members
+
+    def readShard(self, shard):
+        '''Yields (key, members) for every sample of one shard'''
+        for key in self.shardIndex(shard):
+            yield key, self.readSample(shard, key)
+
+def decodeSample(members):
+    '''Decodes the json and the array members of a sample, the image stays encoded'''
+    sample = dict(members)
+    if 'json' in sample:
+        sample['json'] = json.loads(sample['json'].decode('utf-8'))
+    for extension in sample:
+        if extension.endswith('.npy'):
+            sample[extension] = np.load(io.BytesIO(sample[extension]))
+    return sample
@@ -0,0 +1,51 @@
+'''
+End to end benchmark of SatteliteData.Generator.generateData on a synthetic model
+at a fixed resolution, prints the per stage timings and can write the trace.
+
+Usage:
+    python benchmarks/generation_benchmark.py --frames 50 --profile fast --trace trace.csv
+    python benchmarks/generation_benchmark.py --frames 10000 --segmentation exr --memory-interval 500
+'''
+import argparse
+import os
+import sys
+import tempfile
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from BlenderDataGenerator import SatteliteData
+
+import synthetic
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--frames', type=int, default=20)
+    parser.add_argument('--resolution', type=int, nargs=2, default=(640, 480))
+    parser.add_argument('--vertices', type=int, default=20000, help='approximate vertex count of the model')
+    parser.add_argument('--profile', default='fast', help='render profile, see RenderProfiles')
+    parser.add_argument('--segmentation', default='memory', choices=('memory', 'exr'))
+    parser.add_argument('--mask-format', default='npy')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--trace', default=None, help='per frame trace, .csv or .json')
+    parser.add_argument('--memory-interval', type=int, default=0, help='sample RSS and datablock counts every N frames')
+    parser.add_argument('--memory-file', default=None, help='memory samples as JSON')
+    parser.add_argument('--output', default=None, help='working directory, a temporary one is used if empty')
+    args = parser.parse_args()
+
+    outputPath = args.output or tempfile.mkdtemp(prefix='generation_benchmark_')
+
+    generator = SatteliteData.Generator(filePath=outputPath, segmentationMode=args.segmentation, seed=args.seed)
+    generator.setObjects(synthetic.createSatellite(generator.scene, args.vertices))
+
+    #Fixed resolution, the profile must not scale it
+    generator.setRenderProfile(args.profile, resolution=args.resolution,
+                               render={'resolution_percentage' : 100})
+    generator.setSegmentationNodes()
+
+    generator.generateData(args.frames, maskFormat=args.mask_format, traceFile=args.trace,
+                           memoryInterval=args.memory_interval, memoryFile=args.memory_file)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,84 @@
+'''
+Benchmark comparing the in memory segmentation read back against the temporary
+exr round trip.
+
+Usage:
+    python benchmarks/segmentation_benchmark.py --object path/to/model.obj --frames 20
+
+Without --object the synthetic satellite from synthetic.py is rendered.
+'''
+import argparse
+import os
+import sys
+import tempfile
+import time
+
+import bpy
+import numpy as np
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from BlenderDataGenerator import SatteliteData
+
+import synthetic
+
+
+def runMode(mode, objectFilePath, frames, resolution, outputPath):
+    '''Renders frames with the given segmentation mode and returns the timings'''
+    generator = SatteliteData.Generator(filePath=os.path.join(outputPath, mode),
+                                        objectFilePath=objectFilePath,
+                                        segmentationMode=mode)
+    if not objectFilePath:
+        generator.setObjects(synthetic.createSatellite(generator.scene))
+    generator.scene.render.resolution_x = resolution[0]
+    generator.scene.render.resolution_y = resolution[1]
+    generator.scene.render.resolution_percentage = 100
+    generator.setSegmentationNodes()
+
+    renderTimes = []
+    readTimes = []
+    checksum = 0.0
+
+    for i in range(frames):
+        start = time.perf_counter()
+        bpy.ops.render.render(write_still=False)
+        renderTimes.append(time.perf_counter() - start)
+
+        start = time.perf_counter()
+        segmentation = generator.getSegmentation()
+        readTimes.append(time.perf_counter() - start)
+
+        checksum += float(segmentation[:,:,0].sum())
+
+    return np.array(renderTimes), np.array(readTimes), checksum
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--object', default=None, help='wavefront obj file to render')
+    parser.add_argument('--frames', type=int, default=10)
+    parser.add_argument('--resolution', type=int, nargs=2, default=(1920, 1080))
+    parser.add_argument('--output', default=None, help='working directory, a temporary one is used if empty')
+    args = parser.parse_args()
+
+    outputPath = args.output or tempfile.mkdtemp(prefix='segmentation_benchmark_')
+
+    results = {}
+    for mode in ('exr', 'memory'):
+        results[mode] = runMode(mode, args.object, args.frames, args.resolution, outputPath)
+
+    print('\nResolution {0}x{1}, {2} frames'.format(args.resolution[0], args.resolution[1], args.frames))
+    print('{0:<8}{1:>14}{2:>14}{3:>14}'.format('mode', 'render [ms]', 'read [ms]', 'total [ms]'))
+    for mode, (renderTimes, readTimes, checksum) in results.items():
+        print('{0:<8}{1:>14.2f}{2:>14.2f}{3:>14.2f}'.format(mode,
+                                                        1000*renderTimes.mean(),
+                                                        1000*readTimes.mean(),
+                                                        1000*(renderTimes + readTimes).mean()))
+
+    #Both paths should produce the same masks
+    if not np.isclose(results['exr'][2], results['memory'][2]):
+        print('Warning: segmentation checksums differ between modes')
+
+
+if __name__ == '__main__':
+    main()
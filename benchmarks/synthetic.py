@@ -0,0 +1,66 @@
+'''
+Procedurally generated satellite used by the benchmarks, so the generator can be
+measured without the proprietary obj files.
+
+The model is a sphere shaped body with two flat solar panels, each part is its own
+object so the segmentation has several pass indices like a separated model.
+'''
+import bpy
+import numpy as np
+
+def sphereMesh(rings, segments, radius):
+    '''Vertices and quad faces of a UV sphere without the poles'''
+    theta = np.linspace(0.1, np.pi - 0.1, rings)
+    phi = np.linspace(0, 2*np.pi, segments, endpoint=False)
+    t, p = np.meshgrid(theta, phi, indexing='ij')
+
+    vertices = np.stack([radius*np.sin(t)*np.cos(p),
+                         radius*np.sin(t)*np.sin(p),
+                         radius*np.cos(t)], axis=-1).reshape(-1, 3)
+
+    r, s = np.meshgrid(np.arange(rings - 1), np.arange(segments), indexing='ij')
+    nextS = (s + 1) % segments
+    faces = np.stack([r*segments + s, r*segments + nextS,
+                      (r+1)*segments + nextS, (r+1)*segments + s], axis=-1).reshape(-1, 4)
+
+    return vertices, faces
+
+def gridMesh(rows, columns, size, offset):
+    '''Vertices and quad faces of a flat grid in the xy plane'''
+    x = np.linspace(-size[0]/2, size[0]/2, columns) + offset[0]
+    y = np.linspace(-size[1]/2, size[1]/2, rows) + offset[1]
+    gx, gy = np.meshgrid(x, y, indexing='ij')
+
+    vertices = np.stack([gx, gy, np.full(gx.shape, offset[2])], axis=-1).reshape(-1, 3)
+
+    c, r = np.meshgrid(np.arange(columns - 1), np.arange(rows - 1), indexing='ij')
+    faces = np.stack([c*rows + r, (c+1)*rows + r,
+                      (c+1)*rows + r + 1, c*rows + r + 1], axis=-1).reshape(-1, 4)
+
+    return vertices, faces
+
+def createObject(scene, name, vertices, faces):
+    '''Creates a mesh object from numpy vertices and faces and links it to the scene'''
+    mesh = bpy.data.meshes.new(name)
+    mesh.from_pydata(vertices.tolist(), [], faces.tolist())
+    mesh.update()
+
+    obj = bpy.data.objects.new(name, mesh)
+    scene.collection.objects.link(obj)
+
+    return obj
+
+def createSatellite(scene, vertices = 20000):
+    '''
+    Creates the synthetic satellite with roughly the given number of vertices,
+    returns the list of part objects
+    '''
+    #Half the vertices on the body, a quarter on each panel
+    side = max(4, int(np.sqrt(vertices / 2)))
+    panel = max(2, int(np.sqrt(vertices / 4)))
+
+    body = createObject(scene, 'Body', *sphereMesh(side, side, 1.0))
+    left = createObject(scene, 'PanelLeft', *gridMesh(panel, panel, (3.0, 1.2), (-2.6, 0.0, 0.0)))
+    right = createObject(scene, 'PanelRight', *gridMesh(panel, panel, (3.0, 1.2), (2.6, 0.0, 0.0)))
+
+    return [body, left, right]